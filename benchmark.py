@@ -0,0 +1,216 @@
+import argparse
+import base64
+import contextlib
+import io
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import main as email_sorter
+
+
+#
+# Synthetic Mailbox
+#
+
+def make_synthetic_message(msg_id, body_size=4000, num_attachments=1):
+    body = "".join(random.choice("abcdefghij klmnopqrstuvwxyz\n") for _ in range(body_size))
+    encoded_body = base64.urlsafe_b64encode(body.encode("utf-8")).decode("ascii")
+    encoded_html = base64.urlsafe_b64encode(f"<html><body>{body}</body></html>".encode("utf-8")).decode("ascii")
+    parts = [
+        {"mimeType": "text/plain", "body": {"data": encoded_body}},
+        {"mimeType": "text/html", "body": {"data": encoded_html}},
+    ]
+    for i in range(num_attachments):
+        # Gmail attachment IDs are long opaque strings
+        parts.append({"mimeType": "application/pdf", "body": {"attachmentId": f"ANGjdJ{msg_id}{i}" + "x" * 300}})
+    return {
+        "id": msg_id,
+        "snippet": body[:150],
+        "payload": {
+            "headers": [
+                {"name": "Subject", "value": f"Synthetic email {msg_id}"},
+                {"name": "From", "value": "Sender <sender@example.com>"},
+                {"name": "To", "value": "me@example.com"},
+                {"name": "Date", "value": "Wed, 20 Feb 2019 09:47:09 -0600"},
+            ],
+            "parts": parts,
+        },
+    }
+
+
+class SyntheticRequest:
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class SyntheticGmailService:
+    """
+    Serves the same synthetic message body under any requested message ID.
+    """
+
+    def __init__(self, body_size):
+        self.template = make_synthetic_message("template", body_size)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def get(self, userId, id, format):
+        message = dict(self.template, id=id)
+        return SyntheticRequest(message)
+
+
+#
+# Benchmarks
+#
+
+def get_peak_rss_kib():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def benchmark_messages(num_messages, body_size):
+    """
+    Fetch, process, save, and chunk `num_messages` synthetic emails, reporting the time and
+    traced allocations per message of each stage, and the peak RSS per message.
+    """
+    service = SyntheticGmailService(body_size)
+    start_rss = get_peak_rss_kib()
+
+    # Fetch + process on its own, without the file and index writes of saving.
+    # It is timed without tracemalloc, which slows it down several times.
+    # process_raw_email_message prints every email
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for i in range(num_messages):
+            email_sorter.process_raw_email_message(email_sorter.get_full_message(service, f"{i:016x}"))
+        process_time = time.perf_counter() - start
+
+        # The peak traced memory of each message is the memory it needs at once
+        records_peak = 0
+        tracemalloc.start()
+        for i in range(num_messages):
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            record = email_sorter.process_raw_email_message(email_sorter.get_full_message(service, f"{i:016x}"))
+            _, peak = tracemalloc.get_traced_memory()
+            records_peak += peak - before
+            del record
+        tracemalloc.stop()
+
+    with tempfile.TemporaryDirectory() as emails_dir:
+        tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(num_messages):
+                email_sorter.save_email_content(service, {"id": f"{i:016x}"}, emails_dir)
+        save_time = time.perf_counter() - start
+        _, save_peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+
+        start = time.perf_counter()
+        chunks = email_sorter.build_email_chunks(emails_dir)
+        chunk_time = time.perf_counter() - start
+        _, chunk_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    peak_rss = get_peak_rss_kib()
+    print(f"messages: {num_messages}, body size: {body_size} chars")
+    print(f"fetch + process: {process_time / num_messages * 1e6:.1f} us/message, "
+          f"{records_peak / num_messages / 1024:.1f} KiB traced/message")
+    # Saving also writes the JSON file and the index row, so it is dominated by I/O
+    print(f"save (fetch, process, JSON file, index): {save_time / num_messages * 1e6:.1f} us/message, "
+          f"{save_peak / num_messages:.1f} B peak traced/message")
+    print(f"chunk: {chunk_time / num_messages * 1e6:.1f} us/message, "
+          f"{chunk_peak / num_messages:.1f} B peak traced/message, {len(chunks)} chunks")
+    print(f"peak RSS: {peak_rss / 1024:.1f} MiB, "
+          f"{(peak_rss - start_rss) * 1024 / num_messages:.1f} B/message above the RSS at start")
+
+
+def benchmark_index(num_messages):
+    """
+    Index `num_messages` synthetic emails and time typical review queries against the index.
+    """
+    # Common words appear in many emails, the generated ones in few, as in a real mailbox
+    words = ["invoice", "receipt", "meeting", "newsletter", "family", "travel", "order", "update", "account", "photos"]
+    words += ["".join(random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(7)) for _ in range(20000)]
+    with tempfile.TemporaryDirectory() as emails_dir:
+        connection = email_sorter.get_index_connection(emails_dir)
+        start = time.perf_counter()
+        with connection:
+            for i in range(num_messages):
+                email = {
+                    "id": f"{i:016x}",
+                    "subject": f"{random.choice(words[:10])} {random.choice(words)} {i}",
+                    "from": f"Sender {i % 5000} <sender{i % 5000}@domain{i % 100}.example.com>",
+                    "to": "me@example.com",
+                    "date": time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime(1262304000 + i * 300)),
+                    "snippet": " ".join(random.choice(words) for _ in range(20)),
+                }
+                email_sorter.write_email_row(connection, email)
+                if i % 10 == 0:
+                    email_sorter.write_classification_row(
+                        connection, {"id": email["id"], "classification": "UNSURE", "reason": "synthetic"}
+                    )
+        print(f"indexed {num_messages} emails in {time.perf_counter() - start:.1f} s")
+
+        queries = {
+            "sender address": {"sender": "sender42@domain42.example.com"},
+            "sender domain": {"sender": "domain7.example.com"},
+            "common keyword": {"text": "invoice"},
+            "rare keyword": {"text": words[10]},
+            "date range": {"after": "2010-06-01", "before": "2010-06-08"},
+            "classification": {"classification": "unsure"},
+            "keyword + classification": {"text": "receipt", "classification": "unsure"},
+        }
+        for name, kwargs in queries.items():
+            start = time.perf_counter()
+            results = email_sorter.search_index(emails_dir, **kwargs)
+            print(f"  {name}: {(time.perf_counter() - start) * 1000:.1f} ms ({len(results)} results)")
+
+
+def benchmark_import_time(top=10):
+    """
+    Report the time to import main.py using `python -X importtime`, and the slowest imports.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        capture_output=True, text=True, check=True
+    )
+    imports = [] # (cumulative_us, module)
+    for line in result.stderr.splitlines()[1:]:
+        _, _, cumulative, module = [field.strip() for field in line.replace(":", "|", 1).split("|")]
+        imports.append((int(cumulative), module))
+    total = next(cumulative for cumulative, module in imports if module == "main")
+    print(f"import main: {total / 1000:.1f} ms")
+    for cumulative, module in sorted(imports, reverse=True)[1:top + 1]:
+        print(f"  {cumulative / 1000:8.1f} ms  {module}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the email pipeline on a synthetic mailbox.")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--body-size", type=int, default=4000)
+    parser.add_argument("--import-time", action="store_true", help="only benchmark the time to import main.py")
+    parser.add_argument("--index", action="store_true", help="only benchmark the email index with --messages emails")
+    args = parser.parse_args()
+    if args.import_time:
+        benchmark_import_time()
+    elif args.index:
+        benchmark_index(args.messages)
+    else:
+        benchmark_messages(args.messages, args.body_size)
+
+
+if __name__ == "__main__": # pragma: no cover
+    main()
@@ -1,16 +1,21 @@
 import os
 import os.path
+import argparse
 import base64
+import functools
 import json
 import multiprocessing
+import queue
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import getaddresses, parseaddr, parsedate_to_datetime
 
-from dotenv import load_dotenv
-from openai import OpenAI
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+# Note: the OpenAI, Google API, and dotenv clients take most of a second to import,
+# so they are imported in the functions that use them rather than here. This keeps
+# commands that only work on local files (and the tests) fast to start.
 
 
 #
@@ -18,6 +23,8 @@ from googleapiclient.errors import HttpError
 #
 KEEP = "KEEP"
 DELETE = "DELETE"
+UNSURE = "UNSURE"
+CLASSIFICATIONS = (KEEP, DELETE, UNSURE)
 
 
 #
@@ -28,11 +35,117 @@ def is_debug():
     return os.environ.get("DEBUG", "0") == "1"
 
 
+def load_env():
+    from dotenv import load_dotenv
+    load_dotenv()
+
+
+#
+# Email Records
+#
+
+def decode_base64_text(data):
+    return base64.urlsafe_b64decode(data).decode('utf-8')
+
+
+class EmailRecord:
+    """
+    A single email, used from fetching it through to building the classification chunks.
+
+    Bodies are kept as the base64 payloads returned by the Gmail API and are only decoded
+    when `body` or `html_body` is read, since most emails are saved without them.
+    Fields can also be read dict-style, e.g. record["subject"] or record["from"].
+    """
+    __slots__ = ("id", "snippet", "headers", "subject", "to", "from_", "date", "cc",
+                 "attachments", "error", "_body_parts", "_html_body_parts")
+
+    # Fields saved to the emails directory, in order
+    SAVED_FIELDS = ("id", "snippet", "subject", "to", "from", "date", "cc", "attachments")
+    KEYS = SAVED_FIELDS + ("headers", "body", "html_body", "error")
+
+    def __init__(self, msg_id, snippet=""):
+        self.id = msg_id
+        self.snippet = snippet
+        self.headers = {}
+        self.subject = None
+        self.to = None
+        self.from_ = None
+        self.date = None
+        self.cc = None
+        self.attachments = ()
+        self.error = None
+        self._body_parts = []
+        self._html_body_parts = []
+
+    @property
+    def body(self):
+        return "".join(decode_base64_text(part) for part in self._body_parts)
+
+    @property
+    def html_body(self):
+        return "".join(decode_base64_text(part) for part in self._html_body_parts)
+
+    def __getitem__(self, key):
+        value = getattr(self, "from_" if key == "from" else key, None) if key in self.KEYS else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        setattr(self, "from_" if key == "from" else key, value)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        """
+        Yield the saved (key, value) pairs, skipping headers that were not set.
+        """
+        for key in self.SAVED_FIELDS:
+            value = self.get(key)
+            if value is not None:
+                yield key, value
+
+    def keys(self):
+        """
+        Yield the saved keys, as returned by `items()`.
+        """
+        for key, _ in self.items():
+            yield key
+
+    def to_dict(self):
+        data = dict(self.items())
+        data["attachments"] = list(self.attachments)
+        return data
+
+
+def format_email_text(email):
+    """
+    Format a saved email (a dict or an EmailRecord) the way it is sent to GPT,
+    with the attachments replaced by their count.
+    """
+    lines = [f"{key}: {value}\n" for key, value in email.items() if key != "attachments"]
+    lines.append(f"num_attachments: {len(email.get('attachments', []))}\n\n")
+    return "".join(lines)
+
+
 #
 # OpenAI API Functions
 #
 
-def get_training_data_prompt(training_data_dir):
+def get_training_data_prompt(training_data_dir, exclude_ids=()):
     prompt = "Here is the training set of emails:\n\n"
     for filename in os.listdir(training_data_dir):
         filepath = os.path.join(training_data_dir, filename)
@@ -41,6 +154,9 @@ def get_training_data_prompt(training_data_dir):
             continue
         with open(filepath, "r") as file:
             data = json.load(file)
+        # leave out emails held out for evaluation
+        if data.get("id") in exclude_ids:
+            continue
         # add attachment count
         data["num_attachments"] = len(data["attachments"])
         del data["attachments"]
@@ -55,7 +171,7 @@ def get_training_data_prompt(training_data_dir):
     return prompt
 
 
-def build_initial_messages(training_data_dir="training_data"):
+def build_initial_messages(training_data_dir="training_data", exclude_ids=()):
     system_message = {
         "role": "system",
         "content": (
@@ -79,7 +195,7 @@ def build_initial_messages(training_data_dir="training_data"):
     
     user_message2 = {
         "role": "user", 
-        "content": get_training_data_prompt(training_data_dir)
+        "content": get_training_data_prompt(training_data_dir, exclude_ids)
     }
     
     gpt_response2 = {
@@ -93,70 +209,965 @@ def build_initial_messages(training_data_dir="training_data"):
 # This function breaks down email data into fix sized chunks so that GPT can 
 # be given an appropriately sized prompt
 EMAILS_DIR = "emails"
-def build_email_chunks(emails_dir=EMAILS_DIR, chunk_size=30000):
+CONTACTS_FILENAME = "contacts.json"
+def build_id_chunks(emails, chunk_size=30000):
+    """
+    Group (email_id, email_text) pairs into chunks of up to `chunk_size` characters.
+
+    Returns:
+    list: An (email_ids, chunk_text) pair per chunk.
+    """
     chunks = []
-    chunk = ""
-    
+    chunk_ids = []
+    chunk = []
+    chunk_len = 0
+
+    for msg_id, email_text in emails:
+        if chunk and chunk_len + len(email_text) > chunk_size:
+            chunks.append((chunk_ids, "".join(chunk)))
+            chunk_ids = []
+            chunk = []
+            chunk_len = 0
+        chunk_ids.append(msg_id)
+        chunk.append(email_text)
+        chunk_len += len(email_text)
+
+    if chunk:
+        chunks.append((chunk_ids, "".join(chunk)))
+    return chunks
+
+
+def build_chunks(email_texts, chunk_size=30000):
+    return [chunk for _, chunk in build_id_chunks(((None, text) for text in email_texts), chunk_size)]
+
+
+def load_email_texts(emails_dir=EMAILS_DIR, exclude_ids=(), contacts=None):
+    """
+    Yield an (email_id, email_text) pair for every saved email not in `exclude_ids`.
+    If `contacts` are given, the history of each email's sender is added to its text.
+    """
     for filename in os.listdir(emails_dir):
         filepath = os.path.join(emails_dir, filename)
 
         if not os.path.isfile(filepath):
             continue
-        
+
         with open(filepath, "r") as email_file:
             data = json.load(email_file)
+        if data.get("id") in exclude_ids:
+            continue
+        if contacts:
+            sender_address = parseaddr(data.get("from") or "")[1].lower()
+            if sender_address in contacts:
+                data["sender_history"] = describe_contact(contacts[sender_address])
+        yield data.get("id"), format_email_text(data)
 
-        # add attachment count and delete attachments
-        data["num_attachments"] = len(data.get("attachments", []))            
-        data.pop("attachments", None)
 
-        email_text = ""
-        for key, value in data.items():
-            email_text += f"{key}: {value}\n"
-        email_text += "\n"
+def build_email_chunks(emails_dir=EMAILS_DIR, chunk_size=30000, exclude_ids=()):
+    return build_chunks((text for _, text in load_email_texts(emails_dir, exclude_ids)), chunk_size)
 
-        if len(chunk) + len(email_text) > chunk_size:
-            chunks.append(chunk)
-            chunk = email_text
-        else:
-            chunk += email_text
 
-    if len(chunk) > 0:
-        chunks.append(chunk)
-    return chunks
+CLASSIFICATIONS_DIR = "classifications"
+# Emails are classified by the first model, and only the ones it is UNSURE about
+# (or whose classification could not be parsed) are passed on to the next model
+CLASSIFICATION_MODELS = ("gpt-4o-mini", "gpt-4o")
+# USD per million (input, output) tokens. References:
+# https://openai.com/api/pricing/
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+}
 
+class ClassificationParser:
+    """
+    Incrementally parse the id/classification/reason blocks of a streamed GPT response,
+    returning each result as soon as its block is complete.
+    """
 
-# def classify_emails():
-#     email_chunks = build_email_chunks()
-    
-#     # The param `os.environ['OPENAI_API_KEY']` is also the default; it can be omitted
-#     client = OpenAI(api_key=os.environ['OPENAI_API_KEY']) 
-    
-#     messages = build_initial_messages()
-    
-#     while True:
-#         # Build list of emails
-#         break
-
-#     user_message = {
-#         "role": "user", 
-#         "content": f"Classify the following emails:\n\n{emails}"
-#     }
+    def __init__(self):
+        self.buffer = ""
+        self.result = None
+
+    def feed(self, text):
+        """
+        Parse the next piece of the response.
+
+        Returns:
+        list: The results completed by this piece.
+        """
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split("\n")
+        results = []
+        for line in lines:
+            results += self.parse_line(line)
+        return results
+
+    def close(self):
+        """
+        Parse the rest of the response, returning the remaining results.
+        """
+        results = self.parse_line(self.buffer)
+        self.buffer = ""
+        return results + self.finish_result()
+
+    def parse_line(self, line):
+        key, separator, value = line.partition(":")
+        # Tolerate markdown formatting around the keys, e.g. "**id**:"
+        key = key.strip().strip("*`").strip().lower()
+        if not separator or key not in ("id", "classification", "reason"):
+            return []
+        results = []
+        if key == "id":
+            results = self.finish_result()
+            self.result = {}
+        if self.result is None:
+            # A classification or reason without an id
+            return results
+        self.result[key] = value.strip()
+        if len(self.result) == 3:
+            results += self.finish_result()
+        return results
+
+    def finish_result(self):
+        result = self.result
+        self.result = None
+        if result is None or "id" not in result or "classification" not in result:
+            return []
+        result["classification"] = result["classification"].upper()
+        if result["classification"] not in CLASSIFICATIONS:
+            return []
+        result.setdefault("reason", "")
+        return [result]
+
+
+def parse_classifications(response):
+    """
+    Parse the id/classification/reason blocks of a GPT response.
+
+    Returns:
+    list: A dict with "id", "classification", and "reason" for each classified email.
+    """
+    parser = ClassificationParser()
+    return parser.feed(response) + parser.close()
+
+
+def classify_chunk(client, initial_messages, chunk, model=CLASSIFICATION_MODELS[-1], on_result=None):
+    """
+    Classify a chunk of emails, streaming the response so that `on_result` is called
+    with each result as soon as it has been received.
+
+    Returns:
+    tuple: The parsed classification results and the token usage of the request.
+    """
+    user_message = {
+        "role": "user", 
+        "content": f"Classify the following emails:\n\n{chunk}"
+    }
     
-#     # References:
-#     # https://platform.openai.com/docs/api-reference/making-requests
-#     # https://platform.openai.com/docs/api-reference/streaming
-#     response = client.chat.completions.create(
-#         model="gpt-4o",
-#         messages=[
-#             system_message,
-#             user_message1, gpt_response1,
-#             user_message2, gpt_response2,
-#         ],
-#         temperature=0
-#     )
-#     response = response.choices[0].message.content.strip()
-#     return response
+    # References:
+    # https://platform.openai.com/docs/api-reference/making-requests
+    # https://platform.openai.com/docs/api-reference/streaming
+    stream = client.chat.completions.create(
+        model=model,
+        messages=initial_messages + [user_message],
+        temperature=0,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+
+    parser = ClassificationParser()
+    results = []
+    usage = None
+    for event in stream:
+        # The last event has no choices, only the token usage of the request
+        if event.usage is not None:
+            usage = event.usage
+        if not event.choices or not event.choices[0].delta.content:
+            continue
+        for result in parser.feed(event.choices[0].delta.content):
+            results.append(result)
+            if on_result:
+                on_result(result)
+    for result in parser.close():
+        results.append(result)
+        if on_result:
+            on_result(result)
+    return results, usage
+
+
+def get_cost(model, prompt_tokens, completion_tokens):
+    if model not in MODEL_PRICES:
+        return None
+    input_price, output_price = MODEL_PRICES[model]
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1e6
+
+
+CLASSIFICATION_RETRIES = 2
+
+def classify_with_cascade(client, initial_messages, emails, models=CLASSIFICATION_MODELS, chunk_size=30000,
+                          on_result=None, max_retries=CLASSIFICATION_RETRIES):
+    """
+    Classify emails with each model in turn, passing on only the emails that a model
+    is UNSURE about or that are missing from its parsed response. The last model's
+    UNSURE results are kept. If a request fails part way through its response, only
+    the emails it had not classified yet are sent again, up to `max_retries` times.
+
+    Parameters:
+    emails (dict): The email text to classify, keyed by email ID.
+    models (list): The models to use, cheapest first.
+    on_result (function): Called with each result as soon as it is streamed back.
+
+    Returns:
+    tuple: The results keyed by email ID (each with the "model" that classified it),
+    and the requests, failed requests, latency, tokens, cost, and number of classified
+    and escalated emails of every model that was used.
+    """
+    results = {}
+    tier_stats = []
+    pending = list(emails)
+    for tier, model in enumerate(models):
+        is_last_tier = tier == len(models) - 1
+        stats = {
+            "model": model,
+            "requests": 0,
+            "failed_requests": 0,
+            "emails": len(pending),
+            "classified": 0,
+            "escalated": 0, # or left unclassified, for the last model
+            "latency": 0.0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cost": 0.0,
+        }
+        tier_stats.append(stats)
+
+        escalated = []
+        unfinished = set()
+        def accept(result):
+            # Ignore any IDs the model made up or repeated
+            if result["id"] not in unfinished:
+                return
+            unfinished.discard(result["id"])
+            if result["classification"] == UNSURE and not is_last_tier:
+                escalated.append(result["id"])
+                return
+            result["model"] = model
+            results[result["id"]] = result
+            stats["classified"] += 1
+            if on_result:
+                on_result(result)
+
+        for chunk_ids, chunk in build_id_chunks(((msg_id, emails[msg_id]) for msg_id in pending), chunk_size):
+            unfinished = set(chunk_ids)
+            for attempt in range(max_retries + 1):
+                if attempt > 0:
+                    # The stream may fail after every result arrived, e.g. before the usage event
+                    if not unfinished:
+                        break
+                    # Only send the emails that were not classified before the failure
+                    chunk = "".join(emails[msg_id] for msg_id in chunk_ids if msg_id in unfinished)
+                start = time.perf_counter()
+                stats["requests"] += 1
+                try:
+                    _, usage = classify_chunk(client, initial_messages, chunk, model, on_result=accept)
+                except Exception as error:
+                    stats["failed_requests"] += 1
+                    print(f"An error occurred: {error}")
+                    continue
+                finally:
+                    stats["latency"] += time.perf_counter() - start
+                if usage is not None:
+                    stats["prompt_tokens"] += usage.prompt_tokens
+                    stats["completion_tokens"] += usage.completion_tokens
+                break
+            escalated += [msg_id for msg_id in chunk_ids if msg_id in unfinished]
+
+        stats["escalated"] = len(escalated)
+        stats["cost"] = get_cost(model, stats["prompt_tokens"], stats["completion_tokens"])
+        pending = escalated
+        if not pending:
+            break
+    return results, tier_stats
+
+
+def print_tier_stats(tier_stats):
+    for stats in tier_stats:
+        cost = "unknown" if stats["cost"] is None else f"${stats['cost']:.4f}"
+        print(f"{stats['model']}: {stats['classified']}/{stats['emails']} emails classified, "
+              f"{stats['escalated']} escalated, {stats['requests']} requests "
+              f"({stats['failed_requests']} failed) in {stats['latency']:.1f}s, "
+              f"{stats['prompt_tokens']} prompt + {stats['completion_tokens']} completion tokens, {cost}")
+
+
+def save_classification(result, classifications_dir=CLASSIFICATIONS_DIR):
+    os.makedirs(classifications_dir, exist_ok=True)
+    with open(os.path.join(classifications_dir, f"{result['id']}.json"), "w") as file:
+        json.dump(result, file, indent=4)
+
+
+def load_classifications(classifications_dir=CLASSIFICATIONS_DIR):
+    """
+    Returns:
+    dict: The saved classification results, keyed by email ID.
+    """
+    classifications = {}
+    if not os.path.isdir(classifications_dir):
+        return classifications
+    for filename in os.listdir(classifications_dir):
+        filepath = os.path.join(classifications_dir, filename)
+        if not os.path.isfile(filepath):
+            continue
+        with open(filepath, "r") as file:
+            result = json.load(file)
+        classifications[result["id"]] = result
+    return classifications
+
+
+def classify_emails(emails_dir=EMAILS_DIR, classifications_dir=CLASSIFICATIONS_DIR, models=CLASSIFICATION_MODELS,
+                    chunk_size=30000, training_data_dir="training_data", contacts_file=CONTACTS_FILENAME, label=False):
+    """
+    Classify every saved email that has not been classified yet, saving one result file per email.
+    If the contacts have been built, each email is sent along with its sender's history.
+    If `label` is set, each email is also labeled in Gmail as soon as its result is streamed back.
+    """
+    from openai import OpenAI
+
+    # The param `os.environ['OPENAI_API_KEY']` is also the default; it can be omitted
+    client = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+    initial_messages = build_initial_messages(training_data_dir)
+    classified = load_classifications(classifications_dir)
+    contacts = load_contacts(contacts_file) if os.path.exists(contacts_file) else None
+    emails = dict(load_email_texts(emails_dir, exclude_ids=classified, contacts=contacts))
+
+    labeling_stage = LabelingStage(get_api_service_obj(), QuotaScheduler()) if label else None
+
+    def save(result):
+        save_classification(result, classifications_dir)
+        index_classification(emails_dir, result)
+        if labeling_stage:
+            labeling_stage.put(result)
+
+    try:
+        results, tier_stats = classify_with_cascade(client, initial_messages, emails, models, chunk_size, on_result=save)
+    finally:
+        if labeling_stage:
+            print(f"Labeled {labeling_stage.close()} emails")
+    print_tier_stats(tier_stats)
+    print(f"Classified {len(results)} emails")
+    return len(results)
+
+
+def load_training_emails(training_data_dir="training_data"):
+    """
+    Returns:
+    tuple: The training email texts (without their classification and reason) and
+    their classifications, both keyed by email ID.
+    """
+    emails = {}
+    labels = {}
+    for filename in os.listdir(training_data_dir):
+        filepath = os.path.join(training_data_dir, filename)
+        if not os.path.isfile(filepath):
+            continue
+        with open(filepath, "r") as file:
+            data = json.load(file)
+        labels[data["id"]] = data.pop("classification").upper()
+        data.pop("reason", None)
+        emails[data["id"]] = format_email_text(data)
+    return emails, labels
+
+
+def get_agreement_report(results, labels):
+    """
+    Compare classification results to the expected labels.
+
+    Returns:
+    dict: The number of emails, how many agree, the agreement rate, and a confusion
+    matrix of {label: {classification: count}}.
+    """
+    report = {"emails": len(labels), "agreed": 0, "agreement": None, "confusion": {}}
+    for msg_id, label in labels.items():
+        classification = results[msg_id]["classification"] if msg_id in results else "UNCLASSIFIED"
+        if classification == label:
+            report["agreed"] += 1
+        confusion = report["confusion"].setdefault(label, {})
+        confusion[classification] = confusion.get(classification, 0) + 1
+    if labels:
+        report["agreement"] = report["agreed"] / len(labels)
+    return report
+
+
+EVALUATION_FOLDS = 5
+
+def evaluate_classification(training_data_dir="training_data", models=CLASSIFICATION_MODELS, chunk_size=30000,
+                            folds=EVALUATION_FOLDS, client=None):
+    """
+    Classify the training emails with the model cascade and report how often each
+    model, and the cascade as a whole, agrees with their labels.
+
+    The training emails are split into `folds` groups. Each group is classified with
+    only the other groups in the prompt, so no email is scored while its own label
+    is one of the examples.
+    """
+    if client is None:
+        from openai import OpenAI
+        client = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+
+    emails, labels = load_training_emails(training_data_dir)
+    msg_ids = sorted(emails)
+    folds = max(2, min(folds, len(msg_ids)))
+    results = {}
+    tier_stats = {} # "model" : stats summed over the folds
+    for fold in range(folds):
+        fold_ids = msg_ids[fold::folds]
+        initial_messages = build_initial_messages(training_data_dir, exclude_ids=set(fold_ids))
+        fold_emails = {msg_id: emails[msg_id] for msg_id in fold_ids}
+        fold_results, fold_tier_stats = classify_with_cascade(client, initial_messages, fold_emails, models, chunk_size)
+        results.update(fold_results)
+        for stats in fold_tier_stats:
+            if stats["model"] not in tier_stats:
+                tier_stats[stats["model"]] = stats
+                continue
+            total = tier_stats[stats["model"]]
+            for key, value in stats.items():
+                if key != "model" and value is not None and total[key] is not None:
+                    total[key] += value
+    print_tier_stats(tier_stats.values())
+
+    report = {"folds": folds, "cascade": get_agreement_report(results, labels)}
+    for model in tier_stats:
+        # Each model is only scored on the emails it classified
+        model_results = {msg_id: result for msg_id, result in results.items() if result["model"] == model}
+        model_labels = {msg_id: labels[msg_id] for msg_id in model_results}
+        report[model] = get_agreement_report(model_results, model_labels)
+    print(f"Agreement with the training labels, with each email held out of the prompt ({folds}-fold):")
+    print(json.dumps(report, indent=4))
+    return report
+
+
+#
+# Email Index
+#
+
+# The index lives in a subdirectory of the emails directory, which build_email_chunks skips
+INDEX_PATH = os.path.join(".index", "emails.db")
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS emails (
+    id TEXT PRIMARY KEY,
+    subject TEXT,
+    sender TEXT,
+    recipient TEXT,
+    cc TEXT,
+    snippet TEXT,
+    date TEXT,
+    timestamp INTEGER,
+    sender_address TEXT,
+    classification TEXT,
+    reason TEXT
+);
+CREATE INDEX IF NOT EXISTS emails_timestamp ON emails (timestamp);
+CREATE INDEX IF NOT EXISTS emails_sender_address ON emails (sender_address, timestamp);
+CREATE INDEX IF NOT EXISTS emails_classification ON emails (classification, timestamp);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(
+    subject, sender, recipient, cc, snippet, reason, content='emails'
+);
+
+-- Keep the full-text index in sync with the emails table
+CREATE TRIGGER IF NOT EXISTS emails_insert AFTER INSERT ON emails BEGIN
+    INSERT INTO emails_fts (rowid, subject, sender, recipient, cc, snippet, reason)
+    VALUES (new.rowid, new.subject, new.sender, new.recipient, new.cc, new.snippet, new.reason);
+END;
+CREATE TRIGGER IF NOT EXISTS emails_delete AFTER DELETE ON emails BEGIN
+    INSERT INTO emails_fts (emails_fts, rowid, subject, sender, recipient, cc, snippet, reason)
+    VALUES ('delete', old.rowid, old.subject, old.sender, old.recipient, old.cc, old.snippet, old.reason);
+END;
+CREATE TRIGGER IF NOT EXISTS emails_update AFTER UPDATE ON emails BEGIN
+    INSERT INTO emails_fts (emails_fts, rowid, subject, sender, recipient, cc, snippet, reason)
+    VALUES ('delete', old.rowid, old.subject, old.sender, old.recipient, old.cc, old.snippet, old.reason);
+    INSERT INTO emails_fts (rowid, subject, sender, recipient, cc, snippet, reason)
+    VALUES (new.rowid, new.subject, new.sender, new.recipient, new.cc, new.snippet, new.reason);
+END;
+"""
+
+index_connections = {} # (pid, thread_id, index_path) : connection
+def get_index_connection(emails_dir=EMAILS_DIR):
+    """
+    Open (or reuse) this thread's connection to the index of `emails_dir`, creating the index if needed.
+    Connections are never shared between processes or threads.
+    """
+    index_path = os.path.join(emails_dir, INDEX_PATH)
+    key = (os.getpid(), threading.get_ident(), index_path)
+    if key not in index_connections:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        # Several sync processes write to the same index, so wait for locks instead of failing
+        connection = sqlite3.connect(index_path, timeout=60)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(INDEX_SCHEMA)
+        index_connections[key] = connection
+    return index_connections[key]
+
+
+def parse_email_timestamp(date):
+    try:
+        return int(parsedate_to_datetime(date).timestamp())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def parse_date_timestamp(date):
+    return int(time.mktime(time.strptime(date, "%Y-%m-%d")))
+
+
+def write_email_row(connection, email):
+    sender = email.get("from")
+    connection.execute(
+        """
+        INSERT INTO emails (id, subject, sender, recipient, cc, snippet, date, timestamp, sender_address)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET
+            subject = excluded.subject, sender = excluded.sender, recipient = excluded.recipient,
+            cc = excluded.cc, snippet = excluded.snippet, date = excluded.date,
+            timestamp = excluded.timestamp, sender_address = excluded.sender_address
+        """,
+        (email["id"], email.get("subject"), sender, email.get("to"), email.get("cc"), email.get("snippet"),
+         email.get("date"), parse_email_timestamp(email.get("date")), parseaddr(sender or "")[1].lower() or None)
+    )
+
+
+def write_classification_row(connection, result):
+    connection.execute(
+        """
+        INSERT INTO emails (id, classification, reason) VALUES (?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET classification = excluded.classification, reason = excluded.reason
+        """,
+        (result["id"], result["classification"], result["reason"])
+    )
+
+
+def index_email(emails_dir, email):
+    """
+    Add a saved email (a dict or an EmailRecord) to the index of `emails_dir`.
+    """
+    connection = get_index_connection(emails_dir)
+    with connection:
+        write_email_row(connection, email)
+
+
+def index_classification(emails_dir, result):
+    connection = get_index_connection(emails_dir)
+    with connection:
+        write_classification_row(connection, result)
+
+
+def update_index(emails_dir=EMAILS_DIR, classifications_dir=CLASSIFICATIONS_DIR):
+    """
+    Index the saved emails and classifications that are not in the index yet,
+    e.g. emails saved before the index existed.
+
+    Returns:
+    int: The number of emails and classifications added.
+    """
+    connection = get_index_connection(emails_dir)
+    indexed_emails = {row["id"] for row in connection.execute("SELECT id FROM emails WHERE subject IS NOT NULL")}
+    indexed_classifications = {
+        row["id"] for row in connection.execute("SELECT id FROM emails WHERE classification IS NOT NULL")
+    }
+
+    num_added = 0
+    with connection:
+        for filename in os.listdir(emails_dir):
+            filepath = os.path.join(emails_dir, filename)
+            # Emails are saved as <id>.json, so indexed emails can be skipped without reading them
+            if not os.path.isfile(filepath) or os.path.splitext(filename)[0] in indexed_emails:
+                continue
+            with open(filepath, "r") as email_file:
+                data = json.load(email_file)
+            if "id" not in data:
+                continue
+            write_email_row(connection, data)
+            num_added += 1
+
+        for msg_id, result in load_classifications(classifications_dir).items():
+            if msg_id not in indexed_classifications:
+                write_classification_row(connection, result)
+                num_added += 1
+    return num_added
+
+
+def quote_fts_query(text):
+    # Quote every word so that characters like ":" or "-" are not read as FTS query syntax
+    return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+
+# Up to this many full-text matches are sorted by date; for more, the emails are walked
+# newest first instead, which stops as soon as `limit` matches are found
+FTS_SORT_LIMIT = 10000
+# Above this share of matching emails, each email is looked up in the full-text index
+# instead of collecting every match first
+FTS_LOOKUP_SHARE = 0.25
+
+def get_match_share(connection, match):
+    """
+    Estimate the share of indexed emails that match the full-text query `match`.
+
+    Returns:
+    float: The estimated share, or None if fewer than FTS_SORT_LIMIT emails match.
+    """
+    row = connection.execute(
+        "SELECT rowid FROM emails_fts WHERE emails_fts MATCH ? ORDER BY rowid LIMIT 1 OFFSET ?",
+        (match, FTS_SORT_LIMIT - 1)
+    ).fetchone()
+    if row is None:
+        return None
+    # Matches are returned in rowid order, and each email has the next rowid
+    return FTS_SORT_LIMIT / row[0]
+
+
+def search_index(emails_dir=EMAILS_DIR, text=None, sender=None, after=None, before=None,
+                 classification=None, limit=100):
+    """
+    Search the index of `emails_dir`, newest emails first.
+
+    Parameters:
+    text (str): Words to find in the subject, from, to, cc, snippet, or classification reason.
+    sender (str): An email address, or words to find in the "from" header (e.g. a name or domain).
+    after (str): Only emails sent on or after this date (YYYY-MM-DD).
+    before (str): Only emails sent before this date (YYYY-MM-DD).
+    classification (str): Only emails with this classification, e.g. "UNSURE".
+    limit (int): The maximum number of emails to return.
+
+    Returns:
+    list: A dict per matching email.
+    """
+    clauses = []
+    params = []
+    fts_queries = []
+    if text:
+        fts_queries.append(quote_fts_query(text))
+    if sender and "@" in sender and " " not in sender.strip():
+        clauses.append("sender_address = ?")
+        params.append(sender.strip().lower())
+    elif sender:
+        fts_queries.append(f"sender : ({quote_fts_query(sender)})")
+    if after:
+        clauses.append("timestamp >= ?")
+        params.append(parse_date_timestamp(after))
+    if before:
+        clauses.append("timestamp < ?")
+        params.append(parse_date_timestamp(before))
+    if classification:
+        clauses.append("classification = ?")
+        params.append(classification.upper())
+
+    connection = get_index_connection(emails_dir)
+    query = "SELECT * FROM emails"
+    if fts_queries:
+        match = " AND ".join(fts_queries)
+        match_clause = "rowid IN (SELECT rowid FROM emails_fts WHERE emails_fts MATCH ?)"
+        # The sender address and classification indexes narrow the search down better
+        if not clauses or all(clause.startswith("timestamp") for clause in clauses):
+            share = get_match_share(connection, match)
+            if share is not None:
+                query += " INDEXED BY emails_timestamp"
+            if share is not None and share >= FTS_LOOKUP_SHARE:
+                match_clause = "EXISTS (SELECT 1 FROM emails_fts WHERE emails_fts MATCH ? AND rowid = emails.rowid)"
+        clauses.insert(0, match_clause)
+        params.insert(0, match)
+
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY timestamp DESC LIMIT ?"
+    params.append(limit)
+    return [dict(row) for row in connection.execute(query, params)]
+
+
+#
+# Contacts
+#
+
+CONTACT_HEADERS = ("from", "to", "cc")
+
+def new_contact():
+    return {
+        "name": "",
+        "from": 0,
+        "to": 0,
+        "cc": 0,
+        "first_date": None, # "YYYY-MM-DD", of any email from, to, or cc'ing this contact
+        "last_date": None,
+        "first_sent": None, # "YYYY-MM-DD", of the emails sent by this contact
+        "last_sent": None,
+        "classifications": {}, # of the emails sent by this contact
+    }
+
+
+def count_contacts(filepaths, classifications_dir=CLASSIFICATIONS_DIR):
+    """
+    Map step of build_contacts: count the contacts of a batch of saved emails.
+
+    Returns:
+    dict: The contact stats, keyed by lowercase email address.
+    """
+    contacts = {}
+    for filepath in filepaths:
+        with open(filepath, "r") as email_file:
+            data = json.load(email_file)
+
+        classification = None
+        classification_path = os.path.join(classifications_dir, f"{data.get('id')}.json")
+        if os.path.exists(classification_path):
+            with open(classification_path, "r") as file:
+                classification = json.load(file)["classification"]
+
+        timestamp = parse_email_timestamp(data.get("date"))
+        date = time.strftime("%Y-%m-%d", time.gmtime(timestamp)) if timestamp is not None else None
+
+        for header in CONTACT_HEADERS:
+            # The to and cc headers can hold several addresses
+            for name, address in getaddresses([data.get(header) or ""]):
+                address = address.strip().lower()
+                if "@" not in address:
+                    continue
+                contact = contacts.setdefault(address, new_contact())
+                if name and not contact["name"]:
+                    contact["name"] = name
+                contact[header] += 1
+                if date:
+                    contact["first_date"] = min(contact["first_date"] or date, date)
+                    contact["last_date"] = max(contact["last_date"] or date, date)
+                if header == "from" and date:
+                    contact["first_sent"] = min(contact["first_sent"] or date, date)
+                    contact["last_sent"] = max(contact["last_sent"] or date, date)
+                if header == "from" and classification:
+                    contact["classifications"][classification] = contact["classifications"].get(classification, 0) + 1
+    return contacts
+
+
+def merge_contacts(contacts, partial_contacts):
+    """
+    Reduce step of build_contacts: merge `partial_contacts` into `contacts`.
+    """
+    for address, partial in partial_contacts.items():
+        if address not in contacts:
+            contacts[address] = partial
+            continue
+        contact = contacts[address]
+        contact["name"] = contact["name"] or partial["name"]
+        for header in CONTACT_HEADERS:
+            contact[header] += partial[header]
+        for key in ("first_date", "first_sent"):
+            dates = [date for date in (contact[key], partial[key]) if date]
+            contact[key] = min(dates) if dates else None
+        for key in ("last_date", "last_sent"):
+            dates = [date for date in (contact[key], partial[key]) if date]
+            contact[key] = max(dates) if dates else None
+        for classification, count in partial["classifications"].items():
+            contact["classifications"][classification] = contact["classifications"].get(classification, 0) + count
+    return contacts
+
+
+def get_contact_count(contact):
+    return contact["from"] + contact["to"] + contact["cc"]
+
+
+def build_contacts(emails_dir=EMAILS_DIR, classifications_dir=CLASSIFICATIONS_DIR, num_processes=None, batch_size=1000):
+    """
+    Count the senders and recipients of all saved emails, as a map-reduce over batches of email files.
+
+    Returns:
+    dict: The contact stats keyed by lowercase email address, most frequent contacts first.
+    """
+    filepaths = [entry.path for entry in os.scandir(emails_dir) if entry.is_file()]
+    batches = [filepaths[i:i + batch_size] for i in range(0, len(filepaths), batch_size)]
+    count_batch = functools.partial(count_contacts, classifications_dir=classifications_dir)
+
+    contacts = {}
+    if is_debug() or len(batches) <= 1:
+        # Run synchronously
+        for batch in batches:
+            merge_contacts(contacts, count_batch(batch))
+    else:
+        # Run asynchronously, merging each batch as soon as it is counted
+        with multiprocessing.Pool(num_processes) as pool:
+            for partial_contacts in pool.imap_unordered(count_batch, batches):
+                merge_contacts(contacts, partial_contacts)
+
+    # Ties are sorted by address so that the order does not depend on which batch finished first
+    return dict(sorted(contacts.items(), key=lambda item: (-get_contact_count(item[1]), item[0])))
+
+
+def save_contacts(contacts, contacts_file=CONTACTS_FILENAME):
+    with open(contacts_file, "w") as file:
+        json.dump(contacts, file, indent=4)
+
+
+def load_contacts(contacts_file=CONTACTS_FILENAME):
+    with open(contacts_file, "r") as file:
+        return json.load(file)
+
+
+def describe_contact(contact):
+    """
+    Summarize a sender's history for the classification prompt,
+    e.g. "12 emails from 2019-02-20 to 2024-05-01, previously classified DELETE 10, KEEP 1".
+    """
+    description = f"{contact['from']} emails from {contact['first_sent']} to {contact['last_sent']}"
+    if contact["classifications"]:
+        counts = sorted(contact["classifications"].items(), key=lambda item: item[1], reverse=True)
+        description += ", previously classified " + ", ".join(f"{c} {count}" for c, count in counts)
+    return description
+
+
+def find_sender_email_ids(emails_dir, address):
+    """
+    Look up the IDs of all saved emails from `address` in the index.
+    """
+    connection = get_index_connection(emails_dir)
+    rows = connection.execute("SELECT id FROM emails WHERE sender_address = ?", (address.strip().lower(),))
+    return [row["id"] for row in rows]
+
+
+#
+# Gmail Quota Scheduling
+#
+
+# Quota units charged for each Gmail API method. References:
+# https://developers.google.com/gmail/api/reference/quota
+GMAIL_QUOTA_UNITS = {
+    "labels.list": 1,
+    "labels.create": 5,
+    "labels.delete": 5,
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+}
+USER_QUOTA_PER_SECOND = 250
+PROJECT_QUOTA_PER_SECOND = 20000 # 1,200,000 quota units per minute
+
+
+class QuotaBucket:
+    """
+    Token bucket holding up to `capacity` quota units, refilled at `rate` units per second.
+    The bucket itself is not synchronized; callers hold `lock` while using it.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, units):
+        """
+        Return how many seconds to wait until `units` quota units are available (0 if available now).
+        """
+        self.refill()
+        # Allow for floating point error, otherwise waits can shrink to nothing without ever succeeding
+        if self.tokens >= units - 1e-6:
+            return 0
+        return (units - self.tokens) / self.rate
+
+    def take(self, units):
+        self.tokens -= units
+
+
+class QuotaScheduler:
+    """
+    Throttle the Gmail API calls of a single user so they stay under the per-user
+    quota as well as the per-project quota, which may be shared with other users
+    by passing the same `project_bucket` to each scheduler.
+    """
+
+    def __init__(self, user_rate=USER_QUOTA_PER_SECOND, project_bucket=None, clock=time.monotonic, sleep=time.sleep):
+        self.user_bucket = QuotaBucket(user_rate, clock=clock)
+        self.project_bucket = project_bucket or QuotaBucket(PROJECT_QUOTA_PER_SECOND, clock=clock)
+        self.sleep = sleep
+        self.usage = {} # "method" : quota_units
+        self.start_time = clock()
+        self.clock = clock
+
+    def try_acquire(self, units):
+        # The project lock guards both buckets so that quota is taken from both atomically
+        with self.project_bucket.lock:
+            wait = max(self.user_bucket.wait_time(units), self.project_bucket.wait_time(units))
+            if wait <= 0:
+                self.user_bucket.take(units)
+                self.project_bucket.take(units)
+            return wait
+
+    def acquire(self, method):
+        """
+        Block until the quota units for a call to `method` (e.g. "messages.get") are available.
+        """
+        units = GMAIL_QUOTA_UNITS[method]
+        while True:
+            wait = self.try_acquire(units)
+            if wait <= 0:
+                break
+            self.sleep(wait)
+        with self.project_bucket.lock:
+            self.usage[method] = self.usage.get(method, 0) + units
+
+    def back_off(self, seconds):
+        """
+        Drain the user's bucket so that every thread of this user pauses for `seconds`,
+        instead of each of them hitting the rate limit in turn.
+        """
+        with self.project_bucket.lock:
+            self.user_bucket.refill()
+            self.user_bucket.tokens = min(self.user_bucket.tokens, -self.user_bucket.rate * seconds)
+
+    def units_per_second(self):
+        elapsed = max(self.clock() - self.start_time, 1e-9)
+        return sum(self.usage.values()) / elapsed
+
+
+def is_rate_limit_error(error):
+    content = error.content
+    if isinstance(content, bytes):
+        content = content.decode("utf-8", "replace")
+    status = error.resp.status
+    return status == 429 or (status == 403 and "ratelimitexceeded" in content.lower())
+
+
+def execute_gmail_request(request, method, scheduler=None, max_retries=5):
+    """
+    Execute a Gmail API request, waiting for quota first if a scheduler is given.
+
+    Parameters:
+    request (obj): The unexecuted Gmail API request.
+    method (str): The API method of the request, used to look up its quota cost.
+    scheduler (QuotaScheduler): Optional scheduler; without one the request is executed directly.
+    max_retries (int): How many times to retry a rate limited request.
+
+    Returns:
+    dict: The API response.
+    """
+    if scheduler is None:
+        return request.execute()
+
+    from googleapiclient.errors import HttpError
+
+    for attempt in range(max_retries + 1):
+        scheduler.acquire(method)
+        try:
+            return request.execute()
+        except HttpError as error:
+            if attempt == max_retries or not is_rate_limit_error(error):
+                raise
+            # Exponential backoff with jitter
+            scheduler.back_off(min(2 ** attempt, 32) + random.random())
 
 
 #
@@ -167,30 +1178,43 @@ def build_email_chunks(emails_dir=EMAILS_DIR, chunk_size=30000):
 # SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 SCOPES = ["https://www.googleapis.com/auth/gmail.modify"]
 
-def get_api_service_obj():
-    # The file token.json stores the user's access and refresh tokens, and is
+def get_credentials(token_file="token.json", credentials_file="credentials.json"):
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
+    # The token file stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
     # time.
     creds = None
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+    if os.path.exists(token_file):
+        creds = Credentials.from_authorized_user_file(token_file, SCOPES)
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
         else:
             flow = InstalledAppFlow.from_client_secrets_file(
-                "credentials.json", SCOPES
+                credentials_file, SCOPES
             )
             creds = flow.run_local_server(port=0)
         # Save the credentials for the next run
-        with open("token.json", "w") as token:
+        with open(token_file, "w") as token:
             token.write(creds.to_json())
+    return creds
+
+
+def get_api_service_obj(token_file="token.json", credentials_file="credentials.json"):
+    from googleapiclient.discovery import build
+
+    creds = get_credentials(token_file, credentials_file)
     service = build("gmail", "v1", credentials=creds)
     return service
 
 
 def list_labels(service):
+    from googleapiclient.errors import HttpError
+
     try:
         # Call the Gmail API
         results = service.users().labels().list(userId="me").execute()
@@ -243,13 +1267,15 @@ def get_label_id(service, label_name):
     # Search for the label with the specified name
     for label in labels:
         if label["name"] == label_name:
+            label_id_cache[label_name] = label["id"]
             return label["id"]
     
     # Create the label if it does not exist
     new_label = create_label(service, label_name)
     
     # Check if the label creation was successful
-    if 'id' in new_label:
+    if new_label and 'id' in new_label:
+        label_id_cache[label_name] = new_label["id"]
         return new_label["id"]
     else:
         raise Exception(f"Failed to create label: {label_name}")
@@ -265,10 +1291,11 @@ def delete_label(service, label_id):
         return False
 
 
-def list_messages(service, page_token=None, max_results=100):
+def list_messages(service, page_token=None, max_results=100, scheduler=None):
     try:
         # Call the Gmail API to list messages
-        results = service.users().messages().list(userId='me', maxResults=max_results, pageToken=page_token).execute()
+        request = service.users().messages().list(userId='me', maxResults=max_results, pageToken=page_token)
+        results = execute_gmail_request(request, "messages.list", scheduler)
         messages = results.get('messages', [])
         next_page_token = results.get('nextPageToken')
         return messages, next_page_token
@@ -277,71 +1304,71 @@ def list_messages(service, page_token=None, max_results=100):
         return None
 
 
-def get_full_message(service, msg_id):
-    message_data = {
-        "id": msg_id,
-        "snippet": "",
-        "headers": {},
-        "body": "",
-        "html_body": "",
-        "attachments": [],
-    }
+def get_full_message(service, msg_id, scheduler=None):
+    from googleapiclient.errors import HttpError
+
+    message_data = EmailRecord(msg_id)
 
     try:
         # Fetch the full message using the Gmail API
-        message = service.users().messages().get(userId="me", id=msg_id, format='full').execute()
+        request = service.users().messages().get(userId="me", id=msg_id, format='full')
+        message = execute_gmail_request(request, "messages.get", scheduler)
     except HttpError as error:
-        # Store the error in the dictionary if one occurs during the API call
-        message_data["error"] = str(error)
-    
+        # Store the error in the record if one occurs during the API call
+        print(f"An error occurred: {error}")
+        message_data.error = str(error)
+        return message_data
     
-    message_data["snippet"] = message["snippet"]
+    message_data.snippet = message["snippet"]
 
     # Extract headers from the message payload
     headers = message['payload']['headers']
     for header in headers:
-        message_data["headers"][header['name']] = header['value']
+        message_data.headers[header['name']] = header['value']
 
+    # Bodies are decoded lazily by EmailRecord, so only the base64 payloads are kept here
+    attachments = []
     # Check if the message payload contains parts
     if 'parts' in message['payload']:
         for part in message['payload']['parts']:
             if "attachmentId" in part["body"]:
                 # Check if the part contains an attachment
                 # TODO: consider weighing attachments for email sorting
-                message_data["attachments"].append(part["body"]["attachmentId"])
+                attachments.append(part["body"]["attachmentId"])
             elif part['mimeType'] == 'text/plain':
-                # Decode and store the plain text body of the email
+                # Store the plain text body of the email
                 # Double check that we're dealing with a "data" part
                 assert "data" in part["body"]
-                body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-                message_data["body"] += body
+                message_data._body_parts.append(part['body']['data'])
             elif part['mimeType'] == 'text/html':
-                # Decode and store the HTML body of the email
+                # Store the HTML body of the email
                 assert "data" in part["body"]
-                html_body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-                message_data["html_body"] += html_body
+                message_data._html_body_parts.append(part['body']['data'])
     else:
-        # If no parts are found, decode and store the body of the email directly
+        # If no parts are found, store the body of the email directly
         if "data" in message["payload"]["body"]:
-            body = base64.urlsafe_b64decode(message['payload']['body']['data']).decode('utf-8')
-            message_data["body"] = body
+            message_data._body_parts.append(message['payload']['body']['data'])
         elif "attachmentId" in message["payload"]["body"]:
-            message_data["attachments"].append(message['payload']['body']['attachmentId'])
+            attachments.append(message['payload']['body']['attachmentId'])
+    message_data.attachments = tuple(attachments)
     
     return message_data
 
 
-def apply_label(service, msg_id, label_id):
+def apply_label(service, msg_id, label_ids, scheduler=None):
+    from googleapiclient.errors import HttpError
+
     try:
-        # Apply the label to the message
-        message = service.users().messages().modify(
+        # Apply the labels to the message in one call
+        request = service.users().messages().modify(
             # Hardcoding user_id to 'me' - currently do not have a use-case for another user_id
             userId="me",
             id=msg_id,
-            body={'addLabelIds': [label_id]}
-        ).execute()
+            body={'addLabelIds': label_ids}
+        )
+        message = execute_gmail_request(request, "messages.modify", scheduler)
         
-        print(f"Label applied: {label_id} to message ID: {msg_id}")
+        print(f"Labels applied: {label_ids} to message ID: {msg_id}")
         print("Updated Labels: ", message['labelIds'])
         return message
     except HttpError as error:
@@ -349,9 +1376,29 @@ def apply_label(service, msg_id, label_id):
         return None
 
 
-def process_raw_email_message(raw_email):
-    assert isinstance(raw_email["body"], str)
+def batch_apply_label(service, msg_ids, label_ids, scheduler=None):
+    """
+    Apply labels to up to 1000 messages with a single batchModify call.
+
+    Returns:
+    bool: True if the labels were applied.
+    """
+    from googleapiclient.errors import HttpError
+
+    try:
+        request = service.users().messages().batchModify(
+            userId="me",
+            body={'ids': msg_ids, 'addLabelIds': label_ids}
+        )
+        execute_gmail_request(request, "messages.batchModify", scheduler)
+        print(f"Labels applied: {label_ids} to {len(msg_ids)} messages")
+        return True
+    except HttpError as error:
+        print(f'An error occurred: {error}')
+        return False
 
+
+def process_raw_email_message(raw_email):
     # Note: the Subject, From, and Date headers could all possibly differ.
     # For example, the "From" header could also be "FROM" or "Subject" could be "subject".
     # Need to account for these edge cases:
@@ -366,7 +1413,7 @@ def process_raw_email_message(raw_email):
         "to" : "delivered-to"
     }
     for key in headers:
-        for email_header in raw_email["headers"]:
+        for email_header in raw_email.headers:
             if key == email_header.lower():
                 headers[key] = email_header
                 break
@@ -375,9 +1422,8 @@ def process_raw_email_message(raw_email):
                 headers[key] = email_header
                 break
     
-    processed_email = {}
-    processed_email["id"] = raw_email["id"]
-    processed_email["snippet"] = raw_email["snippet"]
+    # The record is filled in place rather than copied into a new dict
+    processed_email = raw_email
 
     print("\n===================================")
     print(f"ID: {processed_email['id']}")
@@ -394,8 +1440,8 @@ def process_raw_email_message(raw_email):
         # Empty 'cc' line is normal/expected
         if key == "cc" and not value:
             continue
-        assert value, f"Error in header: {raw_email['id']=}, {key=}, {value=}, {raw_email['headers'].keys()=}"
-        processed_email[key] = raw_email['headers'][value]
+        assert value, f"Error in header: {raw_email['id']=}, {key=}, {value=}, {raw_email.headers.keys()=}"
+        processed_email[key] = raw_email.headers[value]
         print(f"{key}: {processed_email[key]}")
         
 
@@ -404,15 +1450,15 @@ def process_raw_email_message(raw_email):
     # processed_email["body"] = raw_email["body"][:15000]
     # print(f"Message length: {len(raw_email['body'])}")
     
-    processed_email["attachments"] = raw_email["attachments"]
-    print(f"Attachments: {processed_email['attachments']}")
+    print(f"Attachments: {list(processed_email.attachments)}")
     
     return processed_email
 
 
-def get_email_labels(service, message_id):
+def get_email_labels(service, message_id, scheduler=None):
     try:
-        message = service.users().messages().get(userId='me', id=message_id, format='metadata').execute()
+        request = service.users().messages().get(userId='me', id=message_id, format='metadata')
+        message = execute_gmail_request(request, "messages.get", scheduler)
         return message.get('labelIds', [])
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -420,11 +1466,11 @@ def get_email_labels(service, message_id):
 
 
 PAGE_TOKEN_FILENAME = "page_token.json"
-def load_page_token():
+def load_page_token(filename=PAGE_TOKEN_FILENAME):
     try:
-        with open(PAGE_TOKEN_FILENAME, 'r') as json_file:
+        with open(filename, 'r') as json_file:
             data = json.load(json_file)
-        print(f"Data successfully loaded from {PAGE_TOKEN_FILENAME}")
+        print(f"Data successfully loaded from {filename}")
         assert "page_token" in data
         return data["page_token"]
     except Exception as e:
@@ -432,12 +1478,12 @@ def load_page_token():
         return None
 
 
-def save_page_token(page_token):
+def save_page_token(page_token, filename=PAGE_TOKEN_FILENAME):
     try:
-        with open(PAGE_TOKEN_FILENAME, 'w') as json_file:
+        with open(filename, 'w') as json_file:
             data = { "page_token" : page_token }
             json.dump(data, json_file)
-        print(f"Data successfully saved to {PAGE_TOKEN_FILENAME}")
+        print(f"Data successfully saved to {filename}")
     except Exception as e:
         print(f"An error occurred: {e}")
 
@@ -461,27 +1507,234 @@ def save_page_token(page_token):
 #     # Apply response label
 #     category_name = "_" + response.lower()
 #     category_label_id = get_label_id(service, category_name)
-#     apply_label(service, message["id"], category_label_id)
-    
-#     # Apply "_processed" label
-#     apply_label(service, message["id"], processed_label_id)
+#     # Apply response label and "_processed" label
+#     apply_label(service, message["id"], [category_label_id, processed_label_id])
 
 
-def save_email_content(service, message, emails_dir):
+def save_email_content(service, message, emails_dir, scheduler=None):
     os.makedirs(emails_dir, exist_ok=True)
     filepath = f"{emails_dir}/{message['id']}.json"
     if os.path.exists(filepath):
         # Email already saved
         return
     
-    raw_message = get_full_message(service, message['id'])
+    raw_message = get_full_message(service, message['id'], scheduler)
+    if raw_message.error:
+        # Not saved, so the email is fetched again on the next sync
+        return
     processed_message = process_raw_email_message(raw_message)
     with open(filepath, 'w') as file:
-        json.dump(processed_message, file, indent=4)
+        json.dump(processed_message.to_dict(), file, indent=4)
+    index_email(emails_dir, processed_message)
+
+
+BATCH_MODIFY_LIMIT = 1000 # Max number of IDs google will accept per batchModify
+
+def label_emails(service, classifications_dir=CLASSIFICATIONS_DIR, scheduler=None):
+    """
+    Apply the "_keep", "_delete", or "_unsure" label, plus the "_processed" label,
+    to every classified email using batchModify. Both labels are applied in one call,
+    so an email is never marked processed without its classification label.
+    """
+    msg_ids_by_label = {} # "label_name" : [msg_id, ...]
+    for result in load_classifications(classifications_dir).values():
+        label_name = "_" + result["classification"].lower()
+        msg_ids_by_label.setdefault(label_name, []).append(result["id"])
+
+    processed_label_id = get_label_id(service, "_processed")
+    num_labeled = 0
+    for label_name, msg_ids in msg_ids_by_label.items():
+        label_ids = [get_label_id(service, label_name), processed_label_id]
+        for i in range(0, len(msg_ids), BATCH_MODIFY_LIMIT):
+            batch = msg_ids[i:i + BATCH_MODIFY_LIMIT]
+            if batch_apply_label(service, batch, label_ids, scheduler):
+                num_labeled += len(batch)
+    return num_labeled
+
+
+class LabelingStage:
+    """
+    Label classification results as they arrive, on a background thread so that labeling
+    overlaps with classification. Each email gets its classification label and the
+    "_processed" label in the same call, so they are applied together or not at all.
+    Results that arrive together are labeled with one batchModify call, and a few
+    results with cheaper modify calls.
+    """
+    # One batchModify costs 50 quota units whatever the number of messages, and one
+    # modify per message costs 5 units each, so batchModify is cheaper from 10 messages
+    MIN_BATCH_SIZE = GMAIL_QUOTA_UNITS["messages.batchModify"] // GMAIL_QUOTA_UNITS["messages.modify"]
+
+    def __init__(self, service, scheduler=None):
+        self.service = service
+        self.scheduler = scheduler
+        self.num_labeled = 0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, result):
+        self.queue.put(result)
+
+    def close(self):
+        """
+        Wait for the queued results to be labeled.
+
+        Returns:
+        int: The number of emails labeled.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        return self.num_labeled
+
+    def run(self):
+        closed = False
+        while not closed:
+            # Wait for a result, then take every other result that is already queued
+            results = [self.queue.get()]
+            while True:
+                try:
+                    results.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            closed = None in results
+            try:
+                self.label([result for result in results if result is not None])
+            except Exception as error:
+                print(f"An error occurred: {error}")
+
+    def label(self, results):
+        msg_ids_by_label = {} # "label_name" : [msg_id, ...]
+        for result in results:
+            label_name = "_" + result["classification"].lower()
+            msg_ids_by_label.setdefault(label_name, []).append(result["id"])
+
+        for label_name, msg_ids in msg_ids_by_label.items():
+            label_ids = [get_label_id(self.service, label_name), get_label_id(self.service, "_processed")]
+            for i in range(0, len(msg_ids), BATCH_MODIFY_LIMIT):
+                batch = msg_ids[i:i + BATCH_MODIFY_LIMIT]
+                if len(batch) >= self.MIN_BATCH_SIZE:
+                    if batch_apply_label(self.service, batch, label_ids, self.scheduler):
+                        self.num_labeled += len(batch)
+                    continue
+                for msg_id in batch:
+                    if apply_label(self.service, msg_id, label_ids, self.scheduler):
+                        self.num_labeled += 1
+
+
+def label_sender_emails(service, emails_dir, address, label_name, scheduler=None):
+    """
+    Apply a label to every saved email from `address`, e.g. to delete all emails from a sender at once.
+    """
+    msg_ids = find_sender_email_ids(emails_dir, address)
+    label_id = get_label_id(service, label_name)
+    num_labeled = 0
+    for i in range(0, len(msg_ids), BATCH_MODIFY_LIMIT):
+        batch = msg_ids[i:i + BATCH_MODIFY_LIMIT]
+        if batch_apply_label(service, batch, [label_id], scheduler):
+            num_labeled += len(batch)
+    return num_labeled
+
+
+#
+# Multi-account Sync
+#
+
+ACCOUNTS_DIR = "accounts"
+DEFAULT_SYNC_THREADS = 8
+
+def get_account_paths(token_file, accounts_dir=ACCOUNTS_DIR):
+    """
+    Map a token file to the per-account state: accounts/<token file name>/{emails,page_token.json}
+    """
+    name = os.path.splitext(os.path.basename(token_file))[0]
+    account_dir = os.path.join(accounts_dir, name)
+    return {
+        "name": name,
+        "token_file": token_file,
+        "account_dir": account_dir,
+        "emails_dir": os.path.join(account_dir, "emails"),
+        "page_token_file": os.path.join(account_dir, PAGE_TOKEN_FILENAME),
+    }
+
+
+def sync_account(account, credentials_file="credentials.json", project_rate=PROJECT_QUOTA_PER_SECOND,
+                 num_threads=DEFAULT_SYNC_THREADS, max_results=100):
+    """
+    Save all emails of one account, keeping `num_threads` requests in flight while
+    staying under the account's per-user quota and its share of the project quota.
+
+    Returns:
+    dict: The account name, number of emails synced, and quota units used per method.
+    """
+    from googleapiclient.discovery import build
+
+    os.makedirs(account["account_dir"], exist_ok=True)
+    creds = get_credentials(account["token_file"], credentials_file)
+    scheduler = QuotaScheduler(project_bucket=QuotaBucket(project_rate))
+    list_service = build("gmail", "v1", credentials=creds)
+
+    # Service objects are not thread-safe, so each worker thread builds its own
+    thread_local = threading.local()
+    def save(message):
+        if not hasattr(thread_local, "service"):
+            thread_local.service = build("gmail", "v1", credentials=creds)
+        save_email_content(thread_local.service, message, account["emails_dir"], scheduler)
+
+    page_token = load_page_token(account["page_token_file"])
+    emails_synced = 0
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        while True:
+            save_page_token(page_token, account["page_token_file"])
+            messages, page_token = list_messages(list_service, page_token, max_results, scheduler)
+            # Consume the results so that errors raised in worker threads propagate
+            list(executor.map(save, messages))
+            emails_synced += len(messages)
+            if not page_token:
+                break
+
+    print(f"{account['name']}: synced {emails_synced} emails at {scheduler.units_per_second():.1f} quota units/s")
+    return {
+        "name": account["name"],
+        "emails_synced": emails_synced,
+        "usage": scheduler.usage,
+    }
+
+
+def run_accounts(token_files, credentials_file="credentials.json", accounts_dir=ACCOUNTS_DIR,
+                 num_processes=None, num_threads=DEFAULT_SYNC_THREADS):
+    """
+    Sync several accounts in parallel, one worker process per account at a time.
+
+    Every account has its own token file, page token and emails directory. Each
+    running account gets an equal share of the project quota, so that no account
+    can starve the others and the project as a whole stays under its limit.
+
+    Parameters:
+    token_files (list): The token files, one per account.
+    credentials_file (str): The OAuth client secrets file shared by all accounts.
+    accounts_dir (str): The directory holding the per-account state.
+    num_processes (int): How many accounts to sync at once. Defaults to the number of CPUs.
+    num_threads (int): How many concurrent requests to make per account.
+
+    Returns:
+    list: The `sync_account` result of every account.
+    """
+    accounts = [get_account_paths(token_file, accounts_dir) for token_file in token_files]
+    names = [account["name"] for account in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Token file names must be unique per account: {names}")
+    if not accounts:
+        return []
+
+    num_processes = min(len(accounts), num_processes or multiprocessing.cpu_count())
+    project_rate = PROJECT_QUOTA_PER_SECOND / num_processes
+    params = [(account, credentials_file, project_rate, num_threads) for account in accounts]
+    with multiprocessing.Pool(num_processes) as pool:
+        return pool.starmap(sync_account, params)
 
 
 def main(emails_dir="emails"):
-    load_dotenv()
+    load_env()
     service = get_api_service_obj()
 
     # Loop through the emails and save them locally
@@ -513,30 +1766,140 @@ def main(emails_dir="emails"):
         
         if not page_token:
             break
-        
-    # # Consolidate contacts into a dict
-    # contacts = {} # "email" : email_count
-    # for filename in os.listdir(EMAILS_DIR):
-    #     filepath = os.path.join(EMAILS_DIR, filename)
 
-    #     if not os.path.isfile(filepath):
-    #         continue
-        
-    #     with open(filepath, "r") as email_file:
-    #         data = json.load(email_file)
-    #         print(data)
-    #         headers = ["cc", "to", "from"]
-    #         for header in headers:
-    #             if header in data:
-    #                 contact_name = data[header]
-    #                 contacts[contact_name] = contacts.get(contact_name, 0) + 1
-    # with open("contacts.json", "w") as contacts_file:
-    #     sorted_contacts = dict(sorted(contacts.items(), key=lambda item: item[1], reverse=True))
-    #     json.dump(sorted_contacts, contacts_file, indent=4)
 
 # TODO: update prompt, send new emails to gpt, save sorted email data to processed_emails folder, review
 # TODO: then run on all emails
 
 
+#
+# Command Line Interface
+#
+
+def get_stats(emails_dir=EMAILS_DIR, classifications_dir=CLASSIFICATIONS_DIR):
+    num_emails = 0
+    if os.path.isdir(emails_dir):
+        num_emails = sum(1 for entry in os.scandir(emails_dir) if entry.is_file())
+    classifications = load_classifications(classifications_dir)
+    counts = {classification: 0 for classification in CLASSIFICATIONS}
+    for result in classifications.values():
+        counts[result["classification"]] = counts.get(result["classification"], 0) + 1
+    return {
+        "emails": num_emails,
+        "classified": len(classifications),
+        "classifications": counts,
+    }
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Sort a Gmail inbox into KEEP, DELETE, and UNSURE with GPT.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    sync_parser = subparsers.add_parser("sync", help="save emails locally (the default command)")
+    sync_parser.add_argument("--emails-dir", default=EMAILS_DIR)
+    sync_parser.add_argument("--accounts", nargs="+", metavar="TOKEN_FILE",
+                             help=f"sync several accounts, saving each one under {ACCOUNTS_DIR}/")
+    sync_parser.add_argument("--credentials", default="credentials.json")
+
+    chunk_parser = subparsers.add_parser("chunk", help="show how saved emails are split into GPT prompts")
+    chunk_parser.add_argument("--emails-dir", default=EMAILS_DIR)
+    chunk_parser.add_argument("--chunk-size", type=int, default=30000)
+
+    classify_parser = subparsers.add_parser("classify", help="classify saved emails with GPT")
+    classify_parser.add_argument("--emails-dir", default=EMAILS_DIR)
+    classify_parser.add_argument("--classifications-dir", default=CLASSIFICATIONS_DIR)
+    classify_parser.add_argument("--training-data-dir", default="training_data")
+    classify_parser.add_argument("--models", nargs="+", default=CLASSIFICATION_MODELS,
+                                 help="models to try in turn, cheapest first")
+    classify_parser.add_argument("--chunk-size", type=int, default=30000)
+    classify_parser.add_argument("--label", action="store_true", help="label each email in Gmail as soon as it is classified")
+
+    evaluate_parser = subparsers.add_parser(
+        "evaluate", help="score the models against the training labels, holding each email out of the prompt"
+    )
+    evaluate_parser.add_argument("--training-data-dir", default="training_data")
+    evaluate_parser.add_argument("--folds", type=int, default=EVALUATION_FOLDS,
+                                 help="how many groups to split the training emails into")
+    evaluate_parser.add_argument("--models", nargs="+", default=CLASSIFICATION_MODELS,
+                                 help="models to try in turn, cheapest first")
+    evaluate_parser.add_argument("--chunk-size", type=int, default=30000)
+
+    label_parser = subparsers.add_parser("label", help="apply the classifications as Gmail labels")
+    label_parser.add_argument("--classifications-dir", default=CLASSIFICATIONS_DIR)
+    label_parser.add_argument("--emails-dir", default=EMAILS_DIR)
+    label_parser.add_argument("--sender", help="instead, label every saved email from this address with --label-name")
+    label_parser.add_argument("--label-name", default="_delete")
+
+    contacts_parser = subparsers.add_parser("contacts", help=f"count senders and recipients into {CONTACTS_FILENAME}")
+    contacts_parser.add_argument("--emails-dir", default=EMAILS_DIR)
+    contacts_parser.add_argument("--classifications-dir", default=CLASSIFICATIONS_DIR)
+    contacts_parser.add_argument("--contacts-file", default=CONTACTS_FILENAME)
+    contacts_parser.add_argument("--top", type=int, default=20, help="how many of the most frequent contacts to show")
+
+    stats_parser = subparsers.add_parser("stats", help="count saved and classified emails")
+    stats_parser.add_argument("--emails-dir", default=EMAILS_DIR)
+    stats_parser.add_argument("--classifications-dir", default=CLASSIFICATIONS_DIR)
+
+    index_parser = subparsers.add_parser("index", help="add saved emails and classifications missing from the index")
+    index_parser.add_argument("--emails-dir", default=EMAILS_DIR)
+    index_parser.add_argument("--classifications-dir", default=CLASSIFICATIONS_DIR)
+
+    search_parser = subparsers.add_parser("search", help="search the index of saved emails")
+    search_parser.add_argument("text", nargs="*", help="words to find in the subject, addresses, snippet, or reason")
+    search_parser.add_argument("--emails-dir", default=EMAILS_DIR)
+    search_parser.add_argument("--from", dest="sender", help="an email address, name, or domain")
+    search_parser.add_argument("--after", help="YYYY-MM-DD")
+    search_parser.add_argument("--before", help="YYYY-MM-DD")
+    search_parser.add_argument("--classification", choices=[c.lower() for c in CLASSIFICATIONS], type=str.lower)
+    search_parser.add_argument("--limit", type=int, default=100)
+
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        main()
+    elif args.command == "sync":
+        if args.accounts:
+            load_env()
+            run_accounts(args.accounts, args.credentials)
+        else:
+            main(args.emails_dir)
+    elif args.command == "chunk":
+        chunks = build_email_chunks(args.emails_dir, args.chunk_size)
+        for i, chunk in enumerate(chunks):
+            print(f"chunk {i}: {len(chunk)} characters, {chunk.count('num_attachments:')} emails")
+    elif args.command == "classify":
+        load_env()
+        classify_emails(args.emails_dir, args.classifications_dir, args.models, args.chunk_size, args.training_data_dir,
+                        label=args.label)
+    elif args.command == "evaluate":
+        load_env()
+        evaluate_classification(args.training_data_dir, args.models, args.chunk_size, args.folds)
+    elif args.command == "label":
+        load_env()
+        service = get_api_service_obj()
+        if args.sender:
+            num_labeled = label_sender_emails(service, args.emails_dir, args.sender, args.label_name, QuotaScheduler())
+        else:
+            num_labeled = label_emails(service, args.classifications_dir, QuotaScheduler())
+        print(f"Labeled {num_labeled} emails")
+    elif args.command == "contacts":
+        contacts = build_contacts(args.emails_dir, args.classifications_dir)
+        save_contacts(contacts, args.contacts_file)
+        print(f"Saved {len(contacts)} contacts to {args.contacts_file}")
+        for address, contact in list(contacts.items())[:args.top]:
+            print(f"{get_contact_count(contact):6}  {address}  {describe_contact(contact)}")
+    elif args.command == "stats":
+        print(json.dumps(get_stats(args.emails_dir, args.classifications_dir), indent=4))
+    elif args.command == "index":
+        num_added = update_index(args.emails_dir, args.classifications_dir)
+        print(f"Added {num_added} emails and classifications to the index")
+    elif args.command == "search":
+        results = search_index(args.emails_dir, " ".join(args.text), args.sender, args.after, args.before,
+                               args.classification, args.limit)
+        for result in results:
+            print(f"{result['id']}  {result['date']}  {result['classification'] or '-'}  "
+                  f"{result['sender']}  {result['subject']}")
+
+
 if __name__ == "__main__": # pragma: no cover
-    main()
\ No newline at end of file
+    cli()
\ No newline at end of file
@@ -5,6 +5,12 @@ import json
 import os
 import unittest
 import tempfile
+import base64
+import subprocess
+import sys
+import types
+import httplib2
+from googleapiclient.errors import HttpError
 
 
 # def test_classify_email():
@@ -88,7 +94,7 @@ def test_apply_label_to_message():
     for message in messages:
         message_data = email_sorter.get_full_message(service, message['id'])
         if message_data["headers"]["Subject"] == "test email 002":
-            result_message = email_sorter.apply_label(service, message['id'], new_label['id'])
+            result_message = email_sorter.apply_label(service, message['id'], [new_label['id']])
             assert new_label["id"] in result_message["labelIds"]
     
     # Clean-up: delete random label
@@ -269,4 +275,672 @@ def test_main_debug():
 #     service = email_sorter.get_api_service_obj()
 #     message = service.users().messages().get(userId="me", id=message_id, format='full').execute()    
 #     raw_message = email_sorter.get_full_message(service, message_id)
-#     print(json.dumps(raw_message, indent=4))
\ No newline at end of file
+#     print(json.dumps(raw_message, indent=4))
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_quota_scheduler_stays_under_user_quota():
+    clock = FakeClock()
+    scheduler = email_sorter.QuotaScheduler(user_rate=250, clock=clock, sleep=clock.sleep)
+    # 100 messages.get calls cost 500 units, which takes at least 1 second after the initial burst
+    for _ in range(100):
+        scheduler.acquire("messages.get")
+    assert scheduler.usage == {"messages.get": 500}
+    assert clock.now >= 1.0
+    assert scheduler.units_per_second() <= 500
+
+
+def test_quota_scheduler_shares_project_quota():
+    clock = FakeClock()
+    project_bucket = email_sorter.QuotaBucket(100, clock=clock)
+    schedulers = [
+        email_sorter.QuotaScheduler(project_bucket=project_bucket, clock=clock, sleep=clock.sleep)
+        for _ in range(2)
+    ]
+    for _ in range(20):
+        for scheduler in schedulers:
+            scheduler.acquire("messages.list")
+    # 200 units against a project bucket of 100 units/s with a 100 unit burst
+    assert clock.now >= 1.0
+
+
+class FakeRequest:
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = 0
+
+    def execute(self):
+        response = self.responses[self.calls]
+        self.calls += 1
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def make_http_error(status, content=b""):
+    return HttpError(httplib2.Response({"status": status}), content)
+
+
+def test_execute_gmail_request_retries_rate_limit():
+    clock = FakeClock()
+    scheduler = email_sorter.QuotaScheduler(clock=clock, sleep=clock.sleep)
+    request = FakeRequest([
+        make_http_error(429),
+        make_http_error(403, b'{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}'),
+        {"id": "123"},
+    ])
+    assert email_sorter.execute_gmail_request(request, "messages.get", scheduler) == {"id": "123"}
+    assert request.calls == 3
+    assert scheduler.usage == {"messages.get": 15}
+    # Backed off for 1s and then 2s (plus jitter)
+    assert clock.now >= 3.0
+
+
+def test_execute_gmail_request_raises_other_errors():
+    scheduler = email_sorter.QuotaScheduler()
+    request = FakeRequest([make_http_error(404)])
+    try:
+        email_sorter.execute_gmail_request(request, "messages.get", scheduler)
+        assert False, "Expected HttpError"
+    except HttpError as error:
+        assert error.resp.status == 404
+    assert request.calls == 1
+
+
+def test_get_account_paths():
+    account = email_sorter.get_account_paths("tokens/alice.json", accounts_dir="accounts")
+    assert account["name"] == "alice"
+    assert account["token_file"] == "tokens/alice.json"
+    assert account["emails_dir"] == os.path.join("accounts", "alice", "emails")
+    assert account["page_token_file"] == os.path.join("accounts", "alice", "page_token.json")
+
+
+def test_run_accounts_requires_unique_names():
+    try:
+        email_sorter.run_accounts(["a/alice.json", "b/alice.json"])
+        assert False, "Expected ValueError"
+    except ValueError:
+        pass
+    assert email_sorter.run_accounts([]) == []
+
+
+def make_gmail_message(msg_id, subject, body, attachment_ids=()):
+    encode = lambda text: base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+    parts = [
+        {"mimeType": "text/plain", "body": {"data": encode(body)}},
+        {"mimeType": "text/html", "body": {"data": encode(f"<p>{body}</p>")}},
+    ]
+    for attachment_id in attachment_ids:
+        parts.append({"mimeType": "application/pdf", "body": {"attachmentId": attachment_id}})
+    return {
+        "id": msg_id,
+        "snippet": body[:20],
+        "payload": {
+            "headers": [
+                {"name": "Subject", "value": subject},
+                {"name": "From", "value": "Sender <sender@example.com>"},
+                {"name": "Delivered-To", "value": "me@example.com"},
+                {"name": "Date", "value": "Wed, 20 Feb 2019 09:47:09 -0600"},
+            ],
+            "parts": parts,
+        },
+    }
+
+
+class FakeGmailService:
+    """
+    Stands in for the Gmail API service, serving messages from a dict keyed by ID.
+    """
+
+    def __init__(self, messages):
+        self.messages_by_id = messages
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def get(self, userId, id, format):
+        return FakeRequest([self.messages_by_id[id]])
+
+
+def test_email_record_from_fake_service():
+    service = FakeGmailService({
+        "abc": make_gmail_message("abc", "Hello", "Body text é", attachment_ids=["att1", "att2"]),
+    })
+    record = email_sorter.get_full_message(service, "abc")
+    assert isinstance(record, email_sorter.EmailRecord)
+    assert record["headers"]["Subject"] == "Hello"
+    assert record.body == "Body text é"
+    assert record["html_body"] == "<p>Body text é</p>"
+    assert record.attachments == ("att1", "att2")
+
+    processed = email_sorter.process_raw_email_message(record)
+    assert processed is record
+    assert processed["subject"] == "Hello"
+    assert processed["from"] == "Sender <sender@example.com>"
+    assert processed["to"] == "me@example.com"
+    assert "cc" not in processed
+    assert list(processed.keys()) == ["id", "snippet", "subject", "to", "from", "date", "attachments"]
+    assert processed.to_dict() == {
+        "id": "abc",
+        "snippet": "Body text é",
+        "subject": "Hello",
+        "to": "me@example.com",
+        "from": "Sender <sender@example.com>",
+        "date": "Wed, 20 Feb 2019 09:47:09 -0600",
+        "attachments": ["att1", "att2"],
+    }
+    text = email_sorter.format_email_text(processed)
+    assert "subject: Hello\n" in text
+    assert text.endswith("num_attachments: 2\n\n")
+    assert text == email_sorter.format_email_text(processed.to_dict())
+
+
+def test_build_chunks_skips_empty_chunks():
+    chunks = email_sorter.build_chunks(["a" * 50, "b" * 10, "c" * 45], chunk_size=40)
+    assert chunks == ["a" * 50, "b" * 10, "c" * 45]
+    chunks = email_sorter.build_chunks(["a" * 10, "b" * 10, "c" * 10], chunk_size=20)
+    assert chunks == ["a" * 10 + "b" * 10, "c" * 10]
+
+
+def test_parse_classifications():
+    response = """
+id: 1690b96f1d18385c
+classification: delete
+reason: The email is from 2019 and pertains to orders.
+
+**id**: 1460033c23ee9900
+**classification**: Keep
+**reason**: Personal email from a family member.
+
+id: 1657023ecfa26e4b
+classification: maybe
+reason: Not a valid classification.
+
+id: 1644524c7546bdf2
+"""
+    results = email_sorter.parse_classifications(response)
+    assert results == [
+        {"id": "1690b96f1d18385c", "classification": "DELETE", "reason": "The email is from 2019 and pertains to orders."},
+        {"id": "1460033c23ee9900", "classification": "KEEP", "reason": "Personal email from a family member."},
+    ]
+
+
+def create_classified_emails():
+    emails_dir = tempfile.TemporaryDirectory()
+    classifications_dir = tempfile.TemporaryDirectory()
+    for i, classification in enumerate(["KEEP", "DELETE", "DELETE", None]):
+        email = {"id": f"id{i}", "subject": f"Test Email {i}", "attachments": []}
+        with open(os.path.join(emails_dir.name, f"id{i}.json"), "w") as file:
+            json.dump(email, file)
+        if classification:
+            result = {"id": f"id{i}", "classification": classification, "reason": "test"}
+            email_sorter.save_classification(result, classifications_dir.name)
+    return emails_dir, classifications_dir
+
+
+def test_build_email_chunks_excludes_classified():
+    emails_dir, classifications_dir = create_classified_emails()
+    classified = email_sorter.load_classifications(classifications_dir.name)
+    chunks = email_sorter.build_email_chunks(emails_dir.name, exclude_ids=classified)
+    assert len(chunks) == 1
+    assert "id: id3" in chunks[0]
+    assert "id: id0" not in chunks[0]
+    emails_dir.cleanup()
+    classifications_dir.cleanup()
+
+
+def test_cli_stats_and_chunk(capsys):
+    emails_dir, classifications_dir = create_classified_emails()
+    email_sorter.cli(["stats", "--emails-dir", emails_dir.name, "--classifications-dir", classifications_dir.name])
+    stats = json.loads(capsys.readouterr().out)
+    assert stats == {"emails": 4, "classified": 3, "classifications": {"KEEP": 1, "DELETE": 2, "UNSURE": 0}}
+
+    email_sorter.cli(["chunk", "--emails-dir", emails_dir.name, "--chunk-size", "100"])
+    output = capsys.readouterr().out
+    assert output.count("chunk ") > 1
+    emails_dir.cleanup()
+    classifications_dir.cleanup()
+
+
+def test_import_does_not_load_api_clients():
+    # Guards the import time of main.py: the API clients should only be imported when used
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True
+    )
+    imported = {line.split("|")[-1].strip().split(".")[0] for line in result.stderr.splitlines()}
+    for module in ["openai", "google", "googleapiclient", "google_auth_oauthlib", "dotenv", "httplib2"]:
+        assert module not in imported
+
+
+def create_indexed_emails():
+    emails_dir = tempfile.TemporaryDirectory()
+    emails = [
+        {"id": "a1", "subject": "Your receipt", "from": "Shop <orders@shop.example.com>", "to": "me@example.com",
+         "date": "Wed, 20 Feb 2019 09:47:09 -0600", "snippet": "Thank you for your order", "attachments": []},
+        {"id": "b2", "subject": "Family dinner", "from": "Alice Smith <Alice@Example.com>", "to": "me@example.com",
+         "date": "Sat, 01 Jun 2024 18:00:00 +0000", "snippet": "See you on Sunday", "attachments": []},
+        {"id": "c3", "subject": "Weekly newsletter", "from": "News <news@example.org>", "to": "me@example.com",
+         "cc": "alice@example.com", "date": "Mon, 03 Jun 2024 08:00:00 +0000", "snippet": "Top stories",
+         "attachments": []},
+    ]
+    for email in emails:
+        email_sorter.index_email(emails_dir.name, email)
+    email_sorter.index_classification(emails_dir.name, {"id": "a1", "classification": "DELETE", "reason": "Old order"})
+    email_sorter.index_classification(emails_dir.name, {"id": "c3", "classification": "UNSURE", "reason": "Maybe read"})
+    return emails_dir
+
+
+def test_search_index():
+    emails_dir = create_indexed_emails()
+    search = lambda **kwargs: [result["id"] for result in email_sorter.search_index(emails_dir.name, **kwargs)]
+    assert search() == ["c3", "b2", "a1"]
+    assert search(text="receipt") == ["a1"]
+    assert search(text="old order") == ["a1"]
+    assert search(text="alice") == ["c3", "b2"]
+    assert search(sender="alice@example.com") == ["b2"]
+    assert search(sender="Alice Smith") == ["b2"]
+    assert search(sender="example.com") == ["b2", "a1"]
+    assert search(after="2024-01-01") == ["c3", "b2"]
+    assert search(before="2024-06-02") == ["b2", "a1"]
+    assert search(classification="unsure") == ["c3"]
+    assert search(text="re: newsletter-") == []
+    assert email_sorter.search_index(emails_dir.name, text="dinner")[0]["subject"] == "Family dinner"
+    emails_dir.cleanup()
+
+
+def test_search_index_walks_emails_for_common_words(monkeypatch):
+    emails_dir = create_indexed_emails()
+    search = lambda **kwargs: [result["id"] for result in email_sorter.search_index(emails_dir.name, **kwargs)]
+    queries = [{"text": "alice"}, {"text": "example"}, {"sender": "example.com"}, {"text": "alice", "after": "2024-06-02"}]
+    expected = [search(**query) for query in queries]
+    assert expected == [["c3", "b2"], ["c3", "b2", "a1"], ["b2", "a1"], ["c3"]]
+
+    statements = []
+    email_sorter.get_index_connection(emails_dir.name).set_trace_callback(statements.append)
+    # Every word is common enough to walk the emails newest first
+    monkeypatch.setattr(email_sorter, "FTS_SORT_LIMIT", 1)
+    for lookup_share, plan in [(2.0, "rowid IN"), (0.0, "EXISTS")]:
+        monkeypatch.setattr(email_sorter, "FTS_LOOKUP_SHARE", lookup_share)
+        statements.clear()
+        assert [search(**query) for query in queries] == expected
+        searches = [statement for statement in statements if statement.startswith("SELECT * FROM emails")]
+        assert len(searches) == len(queries)
+        assert all("INDEXED BY emails_timestamp" in statement and plan in statement for statement in searches)
+    email_sorter.get_index_connection(emails_dir.name).set_trace_callback(None)
+    emails_dir.cleanup()
+
+
+def test_update_index_is_incremental():
+    emails_dir, classifications_dir = create_classified_emails()
+    assert email_sorter.update_index(emails_dir.name, classifications_dir.name) == 7
+    assert email_sorter.update_index(emails_dir.name, classifications_dir.name) == 0
+    assert len(email_sorter.search_index(emails_dir.name, classification="delete")) == 2
+    # The index directory is not mistaken for an email
+    assert len(email_sorter.build_email_chunks(emails_dir.name)) == 1
+    emails_dir.cleanup()
+    classifications_dir.cleanup()
+
+
+class FakeOpenAI:
+    """
+    Stands in for the OpenAI client, streaming back the given classifications for the
+    email IDs in the prompt a few characters at a time. The first request to a model
+    in `fail_after` fails after streaming that many characters, or before the usage
+    event if the whole response is shorter.
+    """
+
+    def __init__(self, classifications_by_model, fail_after=None):
+        self.classifications_by_model = classifications_by_model
+        self.fail_after = dict(fail_after or {})
+        self.requests = []
+        self.message_lists = []
+        self.chat = types.SimpleNamespace(completions=self)
+
+    def create(self, model, messages, temperature, stream, stream_options):
+        prompt = messages[-1]["content"]
+        self.requests.append((model, prompt))
+        self.message_lists.append(messages)
+        response = ""
+        for msg_id, classification in self.classifications_by_model[model].items():
+            if f"id: {msg_id}\n" in prompt:
+                response += f"id: {msg_id}\nclassification: {classification}\nreason: test\n\n"
+        fail_after = self.fail_after.pop(model, None)
+
+        def events():
+            for i in range(0, len(response), 7):
+                if fail_after is not None and i >= fail_after:
+                    raise ConnectionError("stream interrupted")
+                delta = types.SimpleNamespace(content=response[i:i + 7])
+                yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)], usage=None)
+            if fail_after is not None:
+                raise ConnectionError("stream interrupted")
+            usage = types.SimpleNamespace(prompt_tokens=len(prompt), completion_tokens=len(response))
+            yield types.SimpleNamespace(choices=[], usage=usage)
+        return events()
+
+
+def test_classify_with_cascade():
+    emails = {msg_id: f"id: {msg_id}\nsubject: Test {msg_id}\nnum_attachments: 0\n\n" for msg_id in "abcd"}
+    client = FakeOpenAI({
+        # "c" is missing from the small model's response
+        "gpt-4o-mini": {"a": "keep", "b": "unsure", "d": "delete"},
+        "gpt-4o": {"b": "delete", "c": "unsure"},
+    })
+    saved = []
+    results, tier_stats = email_sorter.classify_with_cascade(client, [], emails, chunk_size=100, on_result=saved.append)
+
+    assert {msg_id: (result["classification"], result["model"]) for msg_id, result in results.items()} == {
+        "a": ("KEEP", "gpt-4o-mini"),
+        "d": ("DELETE", "gpt-4o-mini"),
+        "b": ("DELETE", "gpt-4o"),
+        "c": ("UNSURE", "gpt-4o"),
+    }
+    assert len(saved) == 4
+    small, large = tier_stats
+    assert (small["emails"], small["classified"], small["escalated"]) == (4, 2, 2)
+    assert (large["emails"], large["classified"], large["escalated"]) == (2, 2, 0)
+    # Only the escalated emails are re-chunked for the large model
+    large_prompts = [prompt for model, prompt in client.requests if model == "gpt-4o"]
+    assert small["requests"] == 2 and large["requests"] == len(large_prompts) == 1
+    assert "id: a\n" not in large_prompts[0]
+    assert small["prompt_tokens"] > 0
+    assert small["cost"] == email_sorter.get_cost("gpt-4o-mini", small["prompt_tokens"], small["completion_tokens"])
+    assert email_sorter.get_cost("gpt-4o", 1000000, 1000000) == 12.5
+    assert email_sorter.get_cost("unknown-model", 1000, 1000) is None
+
+
+def test_get_agreement_report():
+    results = {
+        "a": {"classification": "KEEP"},
+        "b": {"classification": "DELETE"},
+        "c": {"classification": "KEEP"},
+    }
+    labels = {"a": "KEEP", "b": "DELETE", "c": "DELETE", "d": "KEEP"}
+    report = email_sorter.get_agreement_report(results, labels)
+    assert report["emails"] == 4
+    assert report["agreed"] == 2
+    assert report["agreement"] == 0.5
+    assert report["confusion"] == {"KEEP": {"KEEP": 1, "UNCLASSIFIED": 1}, "DELETE": {"DELETE": 1, "KEEP": 1}}
+
+
+def test_load_training_emails():
+    test_dir = create_test_emails()
+    emails, labels = email_sorter.load_training_emails(test_dir.name)
+    assert len(emails) == len(labels) == len(os.listdir(test_dir.name))
+    for msg_id, text in emails.items():
+        assert labels[msg_id] == "DELETE"
+        assert "classification:" not in text and "reason:" not in text
+    test_dir.cleanup()
+
+
+def create_contact_emails():
+    emails_dir = tempfile.TemporaryDirectory()
+    classifications_dir = tempfile.TemporaryDirectory()
+    emails = [
+        {"id": "m1", "from": "Shop <Orders@Shop.example.com>", "to": "me@example.com",
+         "date": "Wed, 20 Feb 2019 09:47:09 -0600", "classification": "DELETE"},
+        {"id": "m2", "from": "orders@shop.example.com", "to": "Me <me@example.com>, Bob <bob@example.com>",
+         "date": "Mon, 03 Jun 2024 08:00:00 +0000", "classification": "DELETE"},
+        {"id": "m3", "from": "Alice <alice@example.com>", "to": "me@example.com", "cc": "bob@example.com",
+         "date": "Sat, 01 Jun 2024 18:00:00 +0000", "classification": None},
+        {"id": "m4", "from": "orders@shop.example.com", "to": "(TO line empty)",
+         "date": "not a date", "classification": "KEEP"},
+    ]
+    for email in emails:
+        classification = email.pop("classification")
+        email.update({"subject": f"Subject {email['id']}", "attachments": []})
+        with open(os.path.join(emails_dir.name, f"{email['id']}.json"), "w") as file:
+            json.dump(email, file)
+        email_sorter.index_email(emails_dir.name, email)
+        if classification:
+            result = {"id": email["id"], "classification": classification, "reason": "test"}
+            email_sorter.save_classification(result, classifications_dir.name)
+    return emails_dir, classifications_dir
+
+
+def test_build_contacts():
+    emails_dir, classifications_dir = create_contact_emails()
+    debug = os.environ.get("DEBUG", "0")
+    try:
+        for os.environ["DEBUG"], batch_size in [("1", 1000), ("0", 1)]:
+            contacts = email_sorter.build_contacts(emails_dir.name, classifications_dir.name, batch_size=batch_size)
+            assert list(contacts)[:2] == ["me@example.com", "orders@shop.example.com"]
+            assert set(contacts) == {"me@example.com", "orders@shop.example.com", "bob@example.com", "alice@example.com"}
+            shop = contacts["orders@shop.example.com"]
+            assert (shop["name"], shop["from"], shop["to"], shop["cc"]) == ("Shop", 3, 0, 0)
+            assert (shop["first_date"], shop["last_date"]) == ("2019-02-20", "2024-06-03")
+            assert shop["classifications"] == {"DELETE": 2, "KEEP": 1}
+            bob = contacts["bob@example.com"]
+            assert (bob["from"], bob["to"], bob["cc"], bob["classifications"]) == (0, 1, 1, {})
+    finally:
+        os.environ["DEBUG"] = debug
+
+    description = email_sorter.describe_contact(shop)
+    assert description == "3 emails from 2019-02-20 to 2024-06-03, previously classified DELETE 2, KEEP 1"
+    texts = dict(email_sorter.load_email_texts(emails_dir.name, contacts=contacts))
+    assert f"sender_history: {description}\n" in texts["m2"]
+    assert sorted(email_sorter.find_sender_email_ids(emails_dir.name, "Orders@shop.example.com")) == ["m1", "m2", "m4"]
+    emails_dir.cleanup()
+    classifications_dir.cleanup()
+
+
+def test_classification_parser_streaming():
+    response = (
+        "id: 1690b96f1d18385c\nclassification: delete\nreason: Old orders.\n\n"
+        "**id**: 1460033c23ee9900\n**reason**: Family.\n**classification**: Keep\n\n"
+        "id: 1657023ecfa26e4b\nclassification: maybe\nreason: Not valid.\n\n"
+        "id: 1644524c7546bdf2\nclassification: unsure\nreason: Last one without a newline"
+    )
+    expected = email_sorter.parse_classifications(response)
+    assert [result["id"] for result in expected] == ["1690b96f1d18385c", "1460033c23ee9900", "1644524c7546bdf2"]
+
+    parser = email_sorter.ClassificationParser()
+    emitted = []
+    for i, char in enumerate(response):
+        for result in parser.feed(char):
+            emitted.append((i, result))
+    emitted += [(len(response), result) for result in parser.close()]
+    assert [result for _, result in emitted] == expected
+    # Each result is emitted as soon as its reason line ends, not at the end of the response
+    assert emitted[0][0] == response.index("Old orders.\n") + len("Old orders.")
+
+
+def test_classify_with_cascade_retries_unfinished_emails():
+    emails = {msg_id: f"id: {msg_id}\nsubject: Test {msg_id}\nnum_attachments: 0\n\n" for msg_id in "abcd"}
+    client = FakeOpenAI(
+        {"gpt-4o": {msg_id: "keep" for msg_id in "abcd"}},
+        # Fails after the results for "a" and "b" have been streamed
+        fail_after={"gpt-4o": 100},
+    )
+    streamed = []
+    results, tier_stats = email_sorter.classify_with_cascade(
+        client, [], emails, models=["gpt-4o"], chunk_size=1000, on_result=lambda result: streamed.append(result["id"])
+    )
+    assert streamed == ["a", "b", "c", "d"]
+    assert set(results) == set("abcd")
+    first_prompt, retry_prompt = [prompt for _, prompt in client.requests]
+    assert "id: a\n" in first_prompt and "id: d\n" in first_prompt
+    assert "id: a\n" not in retry_prompt and "id: b\n" not in retry_prompt
+    assert "id: c\n" in retry_prompt and "id: d\n" in retry_prompt
+    assert (tier_stats[0]["requests"], tier_stats[0]["failed_requests"]) == (2, 1)
+
+
+def test_classify_with_cascade_does_not_retry_finished_chunk():
+    emails = {msg_id: f"id: {msg_id}\nnum_attachments: 0\n\n" for msg_id in "ab"}
+    # Fails after every result has been streamed, before the usage event
+    client = FakeOpenAI({"gpt-4o": {"a": "keep", "b": "delete"}}, fail_after={"gpt-4o": 10000})
+    results, tier_stats = email_sorter.classify_with_cascade(client, [], emails, models=["gpt-4o"])
+    assert set(results) == {"a", "b"}
+    assert len(client.requests) == 1
+    assert (tier_stats[0]["requests"], tier_stats[0]["failed_requests"], tier_stats[0]["escalated"]) == (1, 1, 0)
+
+
+def test_classify_with_cascade_gives_up_after_retries():
+    emails = {msg_id: f"id: {msg_id}\nnum_attachments: 0\n\n" for msg_id in "ab"}
+    client = FakeOpenAI({"gpt-4o-mini": {"a": "keep"}, "gpt-4o": {"a": "keep", "b": "delete"}}, fail_after={"gpt-4o-mini": 0})
+    results, tier_stats = email_sorter.classify_with_cascade(client, [], emails, max_retries=0)
+    # The small model failed, so its emails were escalated to the large model
+    assert {msg_id: result["model"] for msg_id, result in results.items()} == {"a": "gpt-4o", "b": "gpt-4o"}
+    assert tier_stats[0]["failed_requests"] == 1 and tier_stats[0]["escalated"] == 2
+
+
+class FakeLabelService:
+    """
+    Stands in for the Gmail API service, recording the labels applied to messages.
+    """
+
+    def __init__(self, fail_ids=()):
+        self.label_list = [{"name": "_keep", "id": "L1"}, {"name": "_delete", "id": "L2"}, {"name": "_processed", "id": "L3"}]
+        self.calls = []
+        # Messages whose modify call fails
+        self.fail_ids = set(fail_ids)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def labels(self):
+        return self
+
+    def list(self, userId):
+        return FakeRequest([{"labels": self.label_list}])
+
+    def modify(self, userId, id, body):
+        if id in self.fail_ids:
+            return FakeRequest([make_http_error(400)])
+        self.calls.append(("modify", [id], body["addLabelIds"]))
+        return FakeRequest([{"labelIds": body["addLabelIds"]}])
+
+    def batchModify(self, userId, body):
+        self.calls.append(("batchModify", body["ids"], body["addLabelIds"]))
+        return FakeRequest([{}])
+
+
+def test_labeling_stage():
+    email_sorter.label_id_cache.clear()
+    service = FakeLabelService()
+    stage = email_sorter.LabelingStage(service)
+    for i in range(12):
+        stage.put({"id": f"m{i}", "classification": "DELETE"})
+    stage.put({"id": "k", "classification": "KEEP"})
+    assert stage.close() == 13
+    labeled = {}
+    for _, msg_ids, label_ids in service.calls:
+        for msg_id in msg_ids:
+            labeled.setdefault(msg_id, set()).update(label_ids)
+    assert labeled["k"] == {"L1", "L3"}
+    assert all(labeled[f"m{i}"] == {"L2", "L3"} for i in range(12))
+    email_sorter.label_id_cache.clear()
+
+
+def test_labeling_stage_applies_both_labels_together():
+    email_sorter.label_id_cache.clear()
+    service = FakeLabelService(fail_ids={"k"})
+    stage = email_sorter.LabelingStage(service)
+    stage.put({"id": "k", "classification": "KEEP"})
+    stage.put({"id": "m", "classification": "DELETE"})
+    assert stage.close() == 1
+    # Each call carries the category label and _processed, so a failed call applies neither
+    assert service.calls == [("modify", ["m"], ["L2", "L3"])]
+    email_sorter.label_id_cache.clear()
+
+
+def test_save_email_content_skips_failed_fetch():
+    emails_dir = tempfile.TemporaryDirectory()
+    clock = FakeClock()
+    scheduler = email_sorter.QuotaScheduler(clock=clock, sleep=clock.sleep)
+    # Rate limited on every attempt, so the retries run out
+    request = FakeRequest([make_http_error(429)] * 6)
+    service = FakeGmailService({})
+    service.get = lambda userId, id, format: request
+
+    record = email_sorter.get_full_message(service, "gone", scheduler)
+    assert request.calls == 6
+    assert "429" in record.error
+    assert record.attachments == ()
+
+    request.calls = 0
+    email_sorter.save_email_content(service, {"id": "gone"}, emails_dir.name, scheduler)
+    assert request.calls == 6
+    assert not os.path.exists(os.path.join(emails_dir.name, "gone.json"))
+    assert email_sorter.search_index(emails_dir.name) == []
+    emails_dir.cleanup()
+
+
+def test_label_emails_applies_both_labels_in_one_call():
+    email_sorter.label_id_cache.clear()
+    emails_dir, classifications_dir = create_classified_emails()
+    service = FakeLabelService()
+    clock = FakeClock()
+    scheduler = email_sorter.QuotaScheduler(clock=clock, sleep=clock.sleep)
+    assert email_sorter.label_emails(service, classifications_dir.name, scheduler) == 3
+    assert sorted((sorted(ids), labels) for _, ids, labels in service.calls) == [
+        (["id0"], ["L1", "L3"]),
+        (["id1", "id2"], ["L2", "L3"]),
+    ]
+    assert scheduler.usage["messages.batchModify"] == 2 * email_sorter.GMAIL_QUOTA_UNITS["messages.batchModify"]
+    email_sorter.label_id_cache.clear()
+    emails_dir.cleanup()
+    classifications_dir.cleanup()
+
+
+def test_evaluate_classification_holds_out_scored_emails():
+    test_dir = create_test_emails()
+    emails, labels = email_sorter.load_training_emails(test_dir.name)
+    client = FakeOpenAI({"gpt-4o-mini": {msg_id: "delete" for msg_id in emails}, "gpt-4o": {}})
+    report = email_sorter.evaluate_classification(test_dir.name, chunk_size=100000, folds=4, client=client)
+    assert report["folds"] == 4
+    assert report["cascade"]["emails"] == len(emails)
+    assert report["cascade"]["agreement"] == 1.0
+    assert report["gpt-4o-mini"]["emails"] == len(emails)
+
+    assert len(client.message_lists) == 4
+    for messages in client.message_lists:
+        training_prompt = messages[3]["content"]
+        scored_ids = [msg_id for msg_id in emails if f"id: {msg_id}\n" in messages[-1]["content"]]
+        assert scored_ids
+        for msg_id in emails:
+            # Every email is in the prompt as an example unless it is being scored
+            assert (f"id: {msg_id}\n" in training_prompt) == (msg_id not in scored_ids)
+    test_dir.cleanup()
+
+
+def test_contact_sent_dates_exclude_received_emails():
+    emails_dir = tempfile.TemporaryDirectory()
+    classifications_dir = tempfile.TemporaryDirectory()
+    emails = [
+        {"id": "r1", "from": "alice@example.com", "to": "Bob <bob@example.com>", "date": "Mon, 01 Jan 2001 12:00:00 +0000"},
+        {"id": "s1", "from": "Bob <bob@example.com>", "to": "alice@example.com", "date": "Mon, 03 Jun 2024 08:00:00 +0000"},
+    ]
+    for email in emails:
+        with open(os.path.join(emails_dir.name, f"{email['id']}.json"), "w") as file:
+            json.dump(email, file)
+
+    debug = os.environ.get("DEBUG", "0")
+    try:
+        for os.environ["DEBUG"], batch_size in [("1", 1000), ("1", 1), ("0", 1)]:
+            contacts = email_sorter.build_contacts(emails_dir.name, classifications_dir.name, batch_size=batch_size)
+            bob = contacts["bob@example.com"]
+            assert (bob["from"], bob["to"]) == (1, 1)
+            assert (bob["first_date"], bob["last_date"]) == ("2001-01-01", "2024-06-03")
+            assert (bob["first_sent"], bob["last_sent"]) == ("2024-06-03", "2024-06-03")
+            assert email_sorter.describe_contact(bob) == "1 emails from 2024-06-03 to 2024-06-03"
+    finally:
+        os.environ["DEBUG"] = debug
+    emails_dir.cleanup()
+    classifications_dir.cleanup()